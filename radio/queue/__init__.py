@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 from .client import Queue
 from . import directory_backend
+from . import sqlite_backend
 try:
     from . import mysql_backend
 except ImportError:
@@ -0,0 +1,476 @@
+"""
+Benchmarks of the queue under mixed read/write workloads.
+
+The `server` workload calls the server functions directly, the `client`
+workload goes through client.Queue and a real socket. Both run against a
+queue loaded by a real backend: `sqlite` uses a temporary database,
+`mysql` uses FakeDatabase in place of MySQL, and doesn't need the MySQLdb
+driver either.
+
+    python -m radio.queue.benchmark --backend sqlite --workload client \\
+        --concurrency 8 --depth 50 --duration 10
+"""
+from __future__ import absolute_import
+import argparse
+import contextlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from . import server
+from .client import Queue
+from .pool import pools
+from .serializer import serializers
+
+
+def percentile(latencies, fraction):
+    """
+    Returns the `fraction` percentile of the sorted `latencies`.
+    """
+    if not latencies:
+        return None
+    return latencies[int(round(fraction * (len(latencies) - 1)))]
+
+
+def normalize(query):
+    return ' '.join(query.split())
+
+
+def fake_driver():
+    """
+    Returns a stand-in for the MySQLdb module, with just enough of it for
+    mysql_backend to import. Nothing can connect through it.
+    """
+    driver = types.ModuleType("MySQLdb")
+    driver.cursors = types.ModuleType("MySQLdb.cursors")
+    driver.cursors.Cursor = object
+    driver.Error = type("Error", (Exception,), {})
+    driver.OperationalError = type("OperationalError", (driver.Error,), {})
+
+    def connect(**options):
+        raise driver.OperationalError("the MySQLdb driver isn't installed")
+    driver.connect = connect
+
+    return driver
+
+
+def import_mysql_backend():
+    """
+    Returns mysql_backend, with `fake_driver` in place of MySQLdb if the
+    driver isn't installed.
+    """
+    try:
+        import MySQLdb
+    except ImportError:
+        driver = fake_driver()
+        sys.modules["MySQLdb"] = driver
+        sys.modules["MySQLdb.cursors"] = driver.cursors
+
+    from . import mysql_backend
+    return mysql_backend
+
+
+class FakeDatabase(object):
+    """
+    An in-memory stand-in for the MySQL database of mysql_backend.
+
+    It answers the queries mysql_backend makes through the connection
+    pool, each after `latency` seconds to stand in for the round trip to a
+    database server.
+    """
+    def __init__(self, tracks=10000, latency=0.0):
+        super(FakeDatabase, self).__init__()
+        mysql_backend = import_mysql_backend()
+        self.backend = mysql_backend
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.queries = 0
+
+        # id => [path, artist, len, meta, lastplayed, lastrequested, requestcount]
+        self.tracks = {
+            trackid: ["{0}/{1}.mp3".format(trackid % 100, trackid),
+                      "artist {0}".format(trackid % 997), 120 + trackid % 300,
+                      "artist {0} - track {1}".format(trackid % 997, trackid),
+                      0, 0, 0]
+            for trackid in range(1, tracks + 1)
+        }
+        # id => (trackid, time, type, meta, length)
+        self.queue = {}
+
+        # Queries are matched on their text up to the first placeholder.
+        self.handlers = [
+            (normalize(getattr(mysql_backend, name)).split('%s')[0], handler)
+            for name, handler in (
+                ("TRACK_WEIGHTS", self.track_weights),
+                ("EXPAND_MANY", self.expand_many),
+                ("EXPAND", self.expand),
+                ("LOAD_QUEUE", self.load_queue),
+                ("COUNT_QUEUE", self.count_queue),
+                ("DELETE_QUEUE", self.delete_queue),
+                ("UPSERT_QUEUE", self.upsert_queue),
+                ("LR_UPDATE", self.lr_update),
+            )
+        ]
+
+    def connect(self, **options):
+        """
+        Returns a connection like mysql_backend.connect.
+        """
+        return FakeConnection(self)
+
+    @contextlib.contextmanager
+    def installed(self):
+        """
+        Makes mysql_backend connect to this database in the with block.
+        """
+        connect, self.backend.connect = self.backend.connect, self.connect
+        try:
+            yield self
+        finally:
+            self.backend.connect = connect
+            # Pooled connections would outlive this database.
+            for pool in pools.values():
+                if pool.name.startswith("mysql:"):
+                    pool.close()
+
+    def execute(self, query, args):
+        if self.latency:
+            time.sleep(self.latency)
+
+        query = normalize(query)
+        with self.lock:
+            self.queries += 1
+            for prefix, handler in self.handlers:
+                if query.startswith(prefix):
+                    return handler(args)
+        raise ValueError("unknown query: " + query)
+
+    def track_weights(self, args):
+        return [(trackid, artist, lastplayed, lastrequested, requests)
+                for trackid, (_, artist, _, _, lastplayed, lastrequested, requests)
+                in self.tracks.items()]
+
+    def expand_many(self, args):
+        return [(trackid, track[0], track[2], track[3])
+                for trackid, track in ((trackid, self.tracks.get(trackid)) for trackid in args)
+                if track is not None]
+
+    def expand(self, args):
+        track = self.tracks.get(args[0])
+        return [] if track is None else [(track[0], track[2], track[3])]
+
+    def load_queue(self, args):
+        rows = []
+        for rowid, (trackid, _, type, meta, length) in sorted(self.queue.items()):
+            track = self.tracks.get(trackid) or [None, None, None, None]
+            rows.append((rowid, trackid, meta, length, int(type), track[0], track[2], track[3]))
+        return rows
+
+    def count_queue(self, args):
+        return [(len(self.queue),)]
+
+    def delete_queue(self, args):
+        for rowid in args:
+            self.queue.pop(rowid, None)
+        return []
+
+    def upsert_queue(self, args):
+        for index in range(0, len(args), 6):
+            trackid, time, type, meta, length, rowid = args[index:index + 6]
+            self.queue[rowid] = (trackid, time, type, meta, length)
+        return []
+
+    def lr_update(self, args):
+        now = time.time()
+        for trackid in args:
+            if trackid in self.tracks:
+                self.tracks[trackid][5] = now
+        return []
+
+
+class FakeConnection(object):
+    def __init__(self, database):
+        super(FakeConnection, self).__init__()
+        self.database = database
+
+    def cursor(self, cursor_type=None):
+        return FakeCursor(self.database)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCursor(object):
+    def __init__(self, database):
+        super(FakeCursor, self).__init__()
+        self.database = database
+        self.rows = []
+
+    def execute(self, query, args=None):
+        self.rows = list(self.database.execute(query, args or ()))
+        return len(self.rows)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def backend_queue(backend, tracks, latency, serializer=None):
+    """
+    Yields a queue of `backend` with `tracks` tracks available to it.
+    """
+    directory = tempfile.mkdtemp()
+    config = {
+        "music_root": "/music",
+        "persistence": {"debounce": 0.05, "max_delay": 0.5},
+        "sqlite": {"database": os.path.join(directory, "queue.db")},
+    }
+
+    try:
+        if backend == "mysql":
+            with FakeDatabase(tracks, latency).installed():
+                queue = server.create_queue(backend, config, serializer)
+                with running(queue):
+                    yield queue
+        elif backend == "sqlite":
+            from . import sqlite_backend
+            queue = server.create_queue(backend, config, serializer)
+            sqlite_backend.add_tracks(queue, [
+                ("{0}/{1}.mp3".format(trackid % 100, trackid), 120 + trackid % 300,
+                 "track {0}".format(trackid))
+                for trackid in range(1, tracks + 1)
+            ])
+            with running(queue):
+                yield queue
+        else:
+            raise ValueError("unsupported backend: " + backend)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def running(queue):
+    queue.worker.start()
+    try:
+        yield queue
+    finally:
+        queue.worker.stop()
+        server.shutdown(queue)
+
+
+def server_operations(queue, tracks):
+    """
+    Returns name => function of the operations of the server workload.
+    """
+    return {
+        "pop": lambda: server.pop(queue),
+        "append": lambda: server.append(queue, song(tracks)),
+        "peek": lambda: server.peek(queue),
+        "slice": lambda: server.slice(queue),
+        "length": lambda: server.length(queue),
+    }
+
+
+def client_operations(client, tracks):
+    """
+    Returns name => function of the operations of the client workload.
+    """
+    return {
+        "pop": client.pop,
+        "append": lambda: client.append(song(tracks)),
+        "peek": client.peek,
+        "slice": lambda: client[0:],
+        "length": lambda: len(client),
+    }
+
+
+def song(tracks):
+    songid = random.randint(1, tracks)
+    return {"songid": songid, "metadata": "track {0}".format(songid), "length": 200}
+
+
+def run_workload(operations, mix, concurrency, duration):
+    """
+    Runs the `operations` from `concurrency` threads for `duration`
+    seconds, picking them by the weights in `mix`.
+
+    Returns the latencies by operation name and the elapsed time.
+    """
+    names = [name for name, weight in mix.items() for _ in range(weight)]
+    results = [[] for _ in range(concurrency)]
+    start = time.time()
+    deadline = start + duration
+
+    def work(latencies):
+        while time.time() < deadline:
+            name = random.choice(names)
+            began = time.time()
+            try:
+                operations[name]()
+            except Exception:
+                name += " (error)"
+            latencies.append((name, time.time() - began))
+
+    threads = [threading.Thread(target=work, args=(latencies,)) for latencies in results]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - start
+    latencies = {}
+    for name, latency in (result for thread in results for result in thread):
+        latencies.setdefault(name, []).append(latency)
+
+    return latencies, elapsed
+
+
+def report(latencies, elapsed):
+    lines = ["{0:<16} {1:>8} {2:>10} {3:>10} {4:>10}".format(
+        "operation", "calls", "p50 (ms)", "p99 (ms)", "ops/s")]
+
+    total = 0
+    for name, values in sorted(latencies.items()):
+        values.sort()
+        total += len(values)
+        lines.append("{0:<16} {1:>8} {2:>10.3f} {3:>10.3f} {4:>10.1f}".format(
+            name, len(values), percentile(values, 0.5) * 1000,
+            percentile(values, 0.99) * 1000, len(values) / elapsed))
+
+    lines.append("{0:<16} {1:>8} {2:>10} {3:>10} {4:>10.1f}".format(
+        "total", total, "", "", total / elapsed))
+    return "\n".join(lines)
+
+
+def benchmark(workload="server", backend="sqlite", engine="threaded",
+              concurrency=4, depth=20, duration=5.0, tracks=10000, latency=0.0,
+              mix=None, serializer=None):
+    """
+    Runs one benchmark and returns its report.
+    """
+    mix = mix or {"pop": 1, "append": 1, "peek": 4, "slice": 2, "length": 2}
+
+    with backend_queue(backend, tracks, latency, serializer) as queue:
+        while len(queue) < depth:
+            server.append(queue, song(tracks))
+
+        if workload == "server":
+            operations = server_operations(queue, tracks)
+            return report(*run_workload(operations, mix, concurrency, duration))
+
+        rpc = server.create_server("localhost", 0, {queue.name: queue}, engine)
+        thread = threading.Thread(target=rpc.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            host, port = rpc.server_address
+            client = Queue("http://{0}:{1}/".format(host, port),
+                           pool_size=concurrency, serializer=serializer)
+            operations = client_operations(client, tracks)
+            try:
+                return report(*run_workload(operations, mix, concurrency, duration))
+            finally:
+                client.close()
+        finally:
+            rpc.shutdown()
+            rpc.server_close()
+
+
+def check_persistence(backend="sqlite", tracks=1000, rounds=50):
+    """
+    Moves, removes, appends and pops entries at random, saving after every
+    change, and checks that a queue loaded from the save starts with the
+    same entries. Raises AssertionError on the first difference.
+    """
+    with backend_queue(backend, tracks, 0.0) as queue:
+        # Changes are only made here, the worker would save in between.
+        queue.worker.stop()
+
+        for round in range(rounds):
+            while len(queue) < 5:
+                server.append(queue, song(tracks))
+
+            songids = [entry.songid for entry in queue]
+            change = random.choice(("move", "remove", "append", "pop"))
+            if change == "move":
+                server.move(queue, random.choice(songids), random.randint(0, len(songids) - 1))
+            elif change == "remove":
+                server.remove(queue, random.choice(songids))
+            elif change == "append":
+                server.append(queue, song(tracks))
+            else:
+                server.pop(queue)
+
+            server.save(queue)
+            expected = [entry.songid for entry in queue]
+
+            # Loading populates the new queue, that only appends.
+            loaded = server.create_queue(backend, queue.config)
+            songids = [entry.songid for entry in loaded][:len(expected)]
+            if songids != expected:
+                raise AssertionError("round {0}, after {1}: saved {2}, loaded {3}".format(
+                    round, change, expected, songids))
+
+
+def weights(value):
+    """
+    Parses a mix like "pop=1,append=1,peek=4".
+    """
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = int(weight or 1)
+    return mix
+
+
+parser = argparse.ArgumentParser(description="Benchmark the queue server.")
+parser.add_argument('--workload', help="call the server functions directly or through a client.", default="server", choices=["server", "client"])
+parser.add_argument('--backend', help="queue storage backend to use.", default="sqlite", choices=["sqlite", "mysql"])
+parser.add_argument('--engine', help="jsonrpc server implementation to use.", default="threaded", choices=sorted(server.engines))
+parser.add_argument('--serializer', help="json implementation to use.", default=None, choices=sorted(serializers))
+parser.add_argument('--concurrency', help="amount of concurrent callers.", default=4, type=int)
+parser.add_argument('--depth', help="amount of entries in the queue at the start.", default=20, type=int)
+parser.add_argument('--duration', help="seconds to run for.", default=5.0, type=float)
+parser.add_argument('--tracks', help="amount of tracks known to the backend.", default=10000, type=int)
+parser.add_argument('--latency', help="seconds every fake mysql query takes.", default=0.0, type=float)
+parser.add_argument('--mix', help="relative weights of the operations.", default=None, type=weights)
+parser.add_argument('--check', help="check that saved queues load back the same instead.", action="store_true")
+
+def main():
+    args = parser.parse_args()
+
+    server.logger.setLevel(logging.WARNING)
+    if args.check:
+        check_persistence(args.backend, args.tracks)
+        print "ok"
+        return
+
+    print benchmark(args.workload, args.backend, args.engine, args.concurrency,
+                    args.depth, args.duration, args.tracks, args.latency,
+                    args.mix, args.serializer)
+
+
+if __name__ == "__main__":
+    main()
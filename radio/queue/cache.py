@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+import threading
+import time
+from collections import OrderedDict
+
+
+# All caches that were created, name => Cache
+caches = {}
+
+
+class Cache(object):
+    """
+    A thread-safe LRU cache where entries also expire after `ttl` seconds.
+
+    Caches register themselves by name in `caches` so their hit rates can
+    be reported.
+    """
+    def __init__(self, name, maxsize=1024, ttl=3600):
+        super(Cache, self).__init__()
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        # key => (expires, value), ordered from least to most recently used.
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        caches[name] = self
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires < time.time():
+                self.misses += 1
+                return default
+
+            self.items[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.ttl, value)
+
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """
+        Removes `key` from the cache, or everything if no key is given.
+        """
+        with self.lock:
+            if key is None:
+                self.items.clear()
+            else:
+                self.items.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.items),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": float(self.hits) / lookups if lookups else None,
+            }
@@ -1,26 +1,49 @@
 from __future__ import absolute_import
+import Queue as queue
+import contextlib
 import functools
+import httplib
+import itertools
+import select
 import socket
+import urllib
 
 import jsonrpclib
 
-from .server import create_entry
+from .serializer import find_serializer
+from .server import Entry
+
+
+def to_entries(res):
+    """
+    Turns a dictionary, or a list of them, returned by the server into entries.
+    """
+    if isinstance(res, dict):
+        res = Entry.from_wire(res)
+    elif isinstance(res, list):
+        for i, item in enumerate(res):
+            res[i] = Entry.from_wire(item)
+
+    return res
 
 
 def entrify(function):
     @functools.wraps(function)
     def entrified(*args, **kwargs):
-        res = function(*args, **kwargs)
+        return to_entries(function(*args, **kwargs))
 
-        if isinstance(res, dict):
-            res = create_entry(**res)
-        elif isinstance(res, list):
-            for i, item in enumerate(res):
-                res[i] = create_entry(**item)
+    return entrified
 
-        return res
 
-    return entrified
+def to_wire(song):
+    """
+    Returns the dictionary to send for `song`, which is either an Entry or
+    a dictionary already.
+    """
+    if isinstance(song, Entry):
+        return song.to_wire()
+    return song
+
 def propagate_exceptions(function):
     @functools.wraps(function)
     def exception_handler(*args, **kwargs):
@@ -32,16 +55,41 @@ def propagate_exceptions(function):
                 message = message.split('|', 1)[1]
 
             raise QueueError(message)
-        except socket.error as err:
+        except (socket.error, httplib.HTTPException) as err:
             raise QueueError("Failed to connect.")
 
     return exception_handler
 
 
+def idempotent(function):
+    """
+    Retries a call that failed to reach the server, up to `self.retries`
+    times. Only use this on calls that don't change the queue.
+    """
+    @functools.wraps(function)
+    def retried(self, *args, **kwargs):
+        for attempt in range(self.retries):
+            try:
+                return function(self, *args, **kwargs)
+            except (socket.error, httplib.HTTPException):
+                pass
+
+        return function(self, *args, **kwargs)
+
+    return retried
+
+
 class QueueError(Exception):
     pass
 
 
+class NotSent(socket.error):
+    """
+    Raised when a request failed before it was sent, so the server can't
+    have run it.
+    """
+
+
 class JSONExceptionHandler(type):
     def __new__(cls, name, bases, dct):
         for key, value in dct.iteritems():
@@ -51,13 +99,177 @@ class JSONExceptionHandler(type):
         return type.__new__(cls, name, bases, dct)
 
 
+class Transport(object):
+    """
+    A thread-safe jsonrpclib transport that keeps a pool of persistent
+    HTTP/1.1 connections to the server.
+    """
+    def __init__(self, secure=False, timeout=10, size=4):
+        super(Transport, self).__init__()
+        self.connection_class = httplib.HTTPSConnection if secure else httplib.HTTPConnection
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(maxsize=size)
+
+    def acquire(self, host):
+        """
+        Returns a pooled connection and if it was used before, connections
+        the server already closed are skipped.
+        """
+        while True:
+            try:
+                connection = self.pool.get_nowait()
+            except queue.Empty:
+                return self.connection_class(host, timeout=self.timeout), False
+
+            if not dropped(connection):
+                return connection, True
+            connection.close()
+
+    def release(self, connection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        """
+        Closes all pooled connections.
+        """
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def request(self, host, handler, request_body, verbose=0):
+        connection, reused = self.acquire(host)
+        try:
+            return self.single_request(connection, handler, request_body, verbose)
+        except NotSent:
+            # The server closed an idle connection on us, the request never
+            # reached it so it's sent once more on a new connection. Calls
+            # that failed after sending are only retried by `idempotent`.
+            if not reused:
+                raise
+
+        connection = self.connection_class(host, timeout=self.timeout)
+        return self.single_request(connection, handler, request_body, verbose)
+
+    def single_request(self, connection, handler, request_body, verbose=0):
+        connection.set_debuglevel(verbose)
+        try:
+            connection.putrequest("POST", handler or "/", skip_accept_encoding=True)
+            connection.putheader("Content-Type", "application/json-rpc")
+            connection.putheader("Content-Length", str(len(request_body)))
+            connection.endheaders(request_body)
+        except (socket.error, httplib.HTTPException) as err:
+            connection.close()
+            raise NotSent(str(err))
+
+        try:
+            response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(connection)
+
+        if response.status != 200:
+            raise jsonrpclib.jsonrpc.ProtocolError((response.status, response.reason))
+
+        return data
+
+
+def dropped(connection):
+    """
+    Returns True if the server closed an idle `connection`. An idle
+    connection has nothing to read unless it was closed.
+    """
+    if connection.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (select.error, socket.error):
+        return True
+    return bool(readable)
+
+
+class Proxy(object):
+    """
+    A JSON RPC 2.0 server proxy that encodes and decodes with `serializer`.
+
+    Calls look like method calls, `proxy.peek(index=1)`. It can also be
+    used with `jsonrpclib.MultiCall` to send batches.
+    """
+    def __init__(self, url, transport, serializer):
+        super(Proxy, self).__init__()
+        _, rest = urllib.splittype(url)
+        self._host, self._handler = urllib.splithost(rest)
+        self._transport = transport
+        self._serializer = serializer
+        self._ids = itertools.count(1)
+
+    def _run_request(self, request, notify=None):
+        response = self._transport.request(self._host, self._handler, request)
+        if not response:
+            return None
+        return self._serializer.loads(response)
+
+    def _request(self, method, params):
+        request = self._serializer.dumps({
+            "jsonrpc": "2.0",
+            "id": next(self._ids),
+            "method": method,
+            "params": params,
+        })
+
+        response = self._run_request(request)
+        jsonrpclib.jsonrpc.check_for_errors(response)
+        return response['result']
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            if args and kwargs:
+                raise jsonrpclib.jsonrpc.ProtocolError(
+                    'Cannot use both positional and keyword arguments')
+            return self._request(method, kwargs or list(args))
+
+        return call
+
+
 class Queue(object):
     __metaclass__ = JSONExceptionHandler
 
-    def __init__(self, url=None):
+    def __init__(self, url=None, timeout=10, pool_size=4, retries=2,
+                 serializer=None):
         super(Queue, self).__init__()
-        self.server = jsonrpclib.Server(url)
+        self.retries = retries
+        self.timeout = timeout
+
+        scheme, _ = urllib.splittype(url)
+        if scheme in ('http', 'https'):
+            transport = Transport(secure=scheme == 'https',
+                                  timeout=timeout, size=pool_size)
+            self.server = Proxy(url, transport, find_serializer(serializer))
+        else:
+            self.server = jsonrpclib.Server(url)
+
+    def close(self):
+        """
+        Closes the connections kept open to the server.
+        """
+        transport = getattr(self.server, "_transport", None)
+        if isinstance(transport, Transport):
+            transport.close()
 
+    @idempotent
     @entrify
     def peek(self, index=0):
         return self.server.peek(index=index)
@@ -67,11 +279,12 @@ class Queue(object):
         return self.server.pop()
 
     def append(self, song):
-        return self.server.append(song)
+        return self.server.append(to_wire(song))
 
     def append_request(self, song):
-        return self.server.append_request(song)
+        return self.server.append_request(to_wire(song))
 
+    @idempotent
     @entrify
     def __getitem__(self, point):
         if isinstance(point, slice):
@@ -80,9 +293,139 @@ class Queue(object):
             return self.server.peek(point)
         return None
 
+    @idempotent
     def __len__(self):
         return self.server.length()
 
+    @idempotent
+    def contains(self, songid):
+        return self.server.contains(songid=songid)
+
+    @idempotent
+    def index_of(self, songid):
+        return self.server.index_of(songid=songid)
+
+    @idempotent
     @entrify
+    def find(self, songid):
+        return self.server.find(songid=songid)
+
+    @entrify
+    def remove(self, songid):
+        return self.server.remove(songid=songid)
+
+    def move(self, songid, position):
+        return self.server.move(songid=songid, position=position)
+
+    @idempotent
+    def version(self):
+        return self.server.version()
+
+    @idempotent
+    def changed_since(self, version, start=0, end=None):
+        """
+        Returns a (version, entries) tuple of the queue, entries is None if
+        the queue didn't change since `version`.
+        """
+        res = self.server.slice(start=start, end=end, if_changed_since=version)
+        return res['version'], to_entries(res['entries'])
+
     def __iter__(self):
-        return self[0:len(self)]
\ No newline at end of file
+        return iter(self[0:])
+
+    def wait_for_change(self, version, timeout=30):
+        """
+        Waits for the queue to change from `version`, returns a tuple of
+        the new version and the events since `version`. The events are
+        None if the server no longer knows all of them.
+        """
+        # Make sure the server answers before our connection times out.
+        if self.timeout is not None:
+            timeout = min(timeout, max(self.timeout - 1, 0))
+
+        res = self.server.wait_for_change(version=version, timeout=timeout)
+        events = res['events']
+        for event in events or ():
+            event['entry'] = to_entries(event['entry'])
+
+        return res['version'], events
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Collects calls made on the returned `Batch` and sends them in one
+        request when the with block ends. The server runs them under a
+        single lock, so the results are a consistent snapshot.
+
+        ```python
+        with queue.batch() as batch:
+            batch.length()
+            batch.slice(0, 5)
+        length, entries = batch.results
+        ```
+        """
+        batch = Batch(self.server)
+        yield batch
+        batch.execute()
+
+
+class Batch(object):
+    __metaclass__ = JSONExceptionHandler
+
+    def __init__(self, server):
+        super(Batch, self).__init__()
+        self.multicall = jsonrpclib.MultiCall(server)
+        # For every call, if its result should be turned into entries.
+        self.entries = []
+        self.results = None
+
+    def peek(self, index=0):
+        self.multicall.peek(index=index)
+        self.entries.append(True)
+
+    def pop(self):
+        self.multicall.pop()
+        self.entries.append(True)
+
+    def append(self, song):
+        self.multicall.append(to_wire(song))
+        self.entries.append(False)
+
+    def append_request(self, song):
+        self.multicall.append_request(to_wire(song))
+        self.entries.append(False)
+
+    def slice(self, start=0, end=None):
+        self.multicall.slice(start=start, end=end)
+        self.entries.append(True)
+
+    def length(self):
+        self.multicall.length()
+        self.entries.append(False)
+
+    def version(self):
+        self.multicall.version()
+        self.entries.append(False)
+
+    def contains(self, songid):
+        self.multicall.contains(songid=songid)
+        self.entries.append(False)
+
+    def index_of(self, songid):
+        self.multicall.index_of(songid=songid)
+        self.entries.append(False)
+
+    def find(self, songid):
+        self.multicall.find(songid=songid)
+        self.entries.append(True)
+
+    def execute(self):
+        """
+        Sends all collected calls and returns their results, in call order.
+        """
+        results = self.multicall() or []
+
+        self.results = [to_entries(res) if entries else res
+                        for res, entries in zip(results, self.entries)]
+        self.entries = []
+        return self.results
\ No newline at end of file
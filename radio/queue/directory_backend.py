@@ -1,49 +1,42 @@
 from __future__ import absolute_import, unicode_literals
-import os
+import os.path
 
-import mutagen
+from .library import Library
+from .selection import create_selector
+from .server import Entry, register_backend, logger
+from .watcher import find_watcher
+from .worker import Tasks
 
-from .server import create_entry, register_backend
+
+# Scans the library and refreshes selection weights in the background.
+scan_tasks = Tasks("radio.queue.directory.scan")
 
 
 def populate(queue):
-    for filepath in queue.walker:
-        try:
-            meta = mutagen.File(filepath, easy=True)
-        except:
-            continue
-
-        if not meta:
-            continue
-
-        artist = ", ".join(meta.get('artist', []))
-        title = ", ".join(meta.get('title', []))
-
-        if artist:
-            metadata = "{artist:s} - {title:s}"
-            metadata = metadata.format(artist=artist, title=title)
-        else:
-            metadata = title
-
-        entry = create_entry(
-            songid=queue.amount_of_items,
-            length=int(meta.info.length),
-            metadata=metadata,
-            filename=filepath,
-            request=False,
-        )
-
-        with queue.lock:
-            queue.append(entry)
-            queue.amount_of_items += 1
+    """
+    Fills the queue up to `directory.depth` entries from the library.
+
+    This never touches the disk, the library is kept up to date by the
+    scan and the watcher.
+    """
+    if queue.library.selector.stale():
+        scan_tasks.submit(queue.library.selector.refresh)
+
+    depth = queue.config.get('directory', {}).get('depth', 6)
+
+    with queue.lock:
+        picks = queue.library.pick(depth - len(queue), exclude=queue.songs)
+
+        for path, track in picks:
+            entry = Entry(
+                songid=track.songid,
+                length=track.length,
+                metadata=track.metadata,
+                filename=path,
+                request=False,
+            )
 
-            if len(queue) > 5:
-                break
-    else:
-        # We ran it empty, call ourself again
-        if queue.amount_of_items > 0:
-            load(queue)
-            populate(queue)
+            queue.append(entry)
 
 
 def save(queue):
@@ -51,20 +44,93 @@ def save(queue):
 
 
 def load(queue):
-    directory = queue.config['music_root']
+    options = queue.config.get('directory', {})
+
+    queue.library = Library(
+        queue.config['music_root'],
+        options.get('index', 'library.json'),
+        queue.serializer,
+        create_selector(queue.config),
+        processes=options.get('processes'),
+    )
+    # An existing index can be used right away, the scan only picks up
+    # the changes made since it was saved.
+    queue.library.load()
+
+    queue.watcher = find_watcher(options.get('watcher'))(
+        queue.library,
+        changed=lambda: changed(queue),
+        interval=options.get('poll_interval', 300),
+    )
+    queue.watcher.start()
+    scan_tasks.submit(scan, queue)
+
+
+def scan(queue):
+    """
+    Scans the library in steps of at most `directory.scan_files` files or
+    `directory.scan_seconds` seconds, so the queue is filled from what's
+    found so far in between.
+    """
+    options = queue.config.get('directory', {})
+    files = options.get('scan_files', 1000)
+    seconds = options.get('scan_seconds', 1.0)
+
+    while not queue.library.scan_step(files, seconds):
+        queue.worker.populate()
 
-    queue.walker = walk(directory)
-    queue.amount_of_items = 0
+    changed(queue)
+
+
+def changed(queue):
+    """
+    Drops queued entries of tracks that left the library and fills the
+    queue up again.
+    """
+    with queue.lock:
+        vanished = [entry for entry in queue
+                    if entry.songid and queue.library.get(entry.songid) is None]
+        for entry in vanished:
+            logger.info("removing %s, its file is gone", entry)
+            queue.remove(entry)
+
+    if vanished:
+        queue.worker.save()
+    queue.worker.populate()
+
+
+def played(queue, entry):
+    queue.library.played(entry.songid)
+
+
+def shutdown(queue):
+    """
+    Stops the watcher, which saves the library if it changed.
+    """
+    queue.watcher.stop()
+
+
+def usable(queue, entry):
+    return not entry.filename or os.path.exists(entry.filename)
 
 
 def expand(queue, entry):
-    return entry
+    if not entry.songid or entry.filename:
+        return entry
+
+    track = queue.library.get(entry.songid)
+    if track is None:
+        return entry
 
+    path, track = track
+    entry.filename = path
+    if not entry.length:
+        entry.length = track.length
+    if not entry.metadata:
+        entry.metadata = track.metadata
 
-register_backend("directory", save, load, populate, expand)
+    return entry
 
 
-def walk(directory):
-    for root, _, filenames in os.walk(directory):
-        for filename in filenames:
-            yield os.path.join(root, filename)
\ No newline at end of file
+register_backend("directory", save, load, populate, expand, usable=usable,
+                 played=played, shutdown=shutdown)
@@ -0,0 +1,220 @@
+from __future__ import absolute_import
+import SocketServer
+import socket
+import sys
+import traceback
+import urlparse
+
+import jsonrpclib
+from jsonrpclib import Fault
+from jsonrpclib.SimpleJSONRPCServer import (SimpleJSONRPCServer,
+                                            SimpleJSONRPCDispatcher,
+                                            SimpleJSONRPCRequestHandler,
+                                            get_version, validate_request)
+
+from .serializer import find_serializer
+
+
+class DispatcherMixIn:
+    """
+    Dispatches JSON RPC requests, encoding and decoding them with
+    `serializer`.
+
+    Batch requests are run while holding `batch_lock`, so the results of
+    all calls in a batch form a consistent snapshot. Methods named in
+    `unbatched` wait for other clients, which can't get the lock in the
+    meantime, so they get a fault in a batch.
+    """
+    batch_lock = None
+    serializer = find_serializer("json")
+    unbatched = frozenset()
+
+    def _marshaled_dispatch(self, data, dispatch_method=None):
+        try:
+            request = self.serializer.loads(data)
+        except Exception as err:
+            fault = Fault(-32700, 'Request %s invalid. (%s)' % (data, err))
+            return fault.response()
+
+        if not request:
+            fault = Fault(-32600, 'Request invalid -- no request data.')
+            return fault.response()
+
+        if not isinstance(request, list):
+            return self._marshaled_single_dispatch(request)
+
+        if self.batch_lock is None:
+            responses = [self._marshaled_single_dispatch(req, True) for req in request]
+        else:
+            with self.batch_lock:
+                responses = [self._marshaled_single_dispatch(req, True) for req in request]
+
+        responses = [response for response in responses if response is not None]
+        if not responses:
+            return ''
+        return '[%s]' % ','.join(responses)
+
+    def _marshaled_single_dispatch(self, request, batched=False):
+        valid = validate_request(request)
+        if isinstance(valid, Fault):
+            return valid.response()
+
+        if batched and request['method'] in self.unbatched:
+            result = Fault(-32600, 'Method %s can not be called in a batch.'
+                           % request['method'])
+        else:
+            try:
+                result = self._dispatch(request['method'], request['params'])
+            except Exception:
+                exc_type, exc_value, exc_tb = sys.exc_info()
+                result = Fault(-32603, '%s:%s' % (exc_type, exc_value))
+
+        rpcid = request.get('id')
+        if rpcid is None:
+            # It's a notification
+            return None
+
+        if isinstance(result, Fault):
+            return result.response(rpcid=rpcid, version=get_version(request))
+
+        try:
+            return self.serializer.response(result, rpcid, get_version(request))
+        except Exception:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            fault = Fault(-32603, '%s:%s' % (exc_type, exc_value))
+            return fault.response(rpcid=rpcid)
+
+
+class Dispatcher(DispatcherMixIn, SimpleJSONRPCDispatcher):
+    """
+    The functions served on one of the `routes` of a server.
+    """
+    def __init__(self, batch_lock=None, serializer=None, encoding=None):
+        SimpleJSONRPCDispatcher.__init__(self, encoding)
+        self.batch_lock = batch_lock
+        if serializer is not None:
+            self.serializer = serializer
+
+
+class RequestHandler(SimpleJSONRPCRequestHandler):
+    """
+    Handles JSON RPC requests over HTTP/1.1, the connection is kept open
+    after a response so clients can reuse it for their next call.
+
+    POST requests to one of the `routes` of the server, a dictionary of
+    path => Dispatcher, call the functions of that dispatcher, any other
+    RPC path calls the functions registered on the server itself.
+
+    GET requests are served from the `pages` of the server, a dictionary
+    of path => function(query, headers) that returns the content type and
+    body, or from its `streams`, a dictionary of path => function(query,
+    headers) that returns an iterable of server-sent event messages.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        page = getattr(self.server, "pages", {}).get(path)
+        if page is not None:
+            self.send_page(page, urlparse.parse_qs(query))
+            return
+
+        stream = getattr(self.server, "streams", {}).get(path)
+        if stream is None:
+            self.report_404()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = 1
+
+        try:
+            for message in stream(urlparse.parse_qs(query), self.headers):
+                self.wfile.write(message)
+                self.wfile.flush()
+        except socket.error:
+            # The client went away.
+            pass
+
+    def send_page(self, page, query):
+        content_type, body = page(query, self.headers)
+
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def is_rpc_path_valid(self):
+        return (self.path in getattr(self.server, "routes", {}) or
+                SimpleJSONRPCRequestHandler.is_rpc_path_valid(self))
+
+    def do_POST(self):
+        if not self.is_rpc_path_valid():
+            self.report_404()
+            return
+
+        dispatcher = getattr(self.server, "routes", {}).get(self.path, self.server)
+        try:
+            size = int(self.headers["content-length"])
+            data = self.rfile.read(size)
+            response = dispatcher._marshaled_dispatch(data)
+            self.send_response(200)
+        except Exception:
+            self.send_response(500)
+            err_lines = traceback.format_exc().splitlines()
+            trace_string = '%s | %s' % (err_lines[-3], err_lines[-1])
+            fault = jsonrpclib.Fault(-32603, 'Server error: %s' % trace_string)
+            response = fault.response()
+
+        if response is None:
+            response = ''
+
+        self.send_header("Content-type", "application/json-rpc")
+        self.send_header("Content-length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+        self.wfile.flush()
+
+
+class SingleRequestHandler(RequestHandler):
+    """
+    Handles one request per connection. A server that handles one
+    connection at a time can't keep connections open, an idle client
+    would hold up all others.
+    """
+    protocol_version = "HTTP/1.0"
+
+
+class JSONServer(DispatcherMixIn, SimpleJSONRPCServer):
+    """
+    A JSON RPC server that handles one request at a time.
+    """
+    # If calls can wait without holding up other clients.
+    concurrent = False
+
+    def __init__(self, addr, requestHandler=SingleRequestHandler, **kwargs):
+        SimpleJSONRPCServer.__init__(self, addr, requestHandler, **kwargs)
+
+
+class ThreadedJSONServer(SocketServer.ThreadingMixIn, JSONServer):
+    """
+    A JSON RPC server that handles every connection on its own thread, so
+    a slow call doesn't hold up any other clients.
+    """
+    daemon_threads = True
+    concurrent = True
+
+    def __init__(self, addr, requestHandler=RequestHandler, **kwargs):
+        JSONServer.__init__(self, addr, requestHandler, **kwargs)
+
+
+# Server implementations selectable by name, name => server class
+engines = {
+    "simple": JSONServer,
+    "threaded": ThreadedJSONServer,
+}
@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 
-from .client import Queue
+from .client import Queue, QueueError
 from .server import Entry
 
 
@@ -43,15 +43,13 @@ class Queue(Queue):
         return iter(self[0:5])
 
     def iter(self, limit=None):
-        if not limit:
-            limit = len(self)
-        return self[0:limit]
+        return self[0:limit or None]
 
     def clear_pops(self):
 	pass # yep it does nothing
 
     def get(self, song):
-        for s in self[0:len(self)]:
-            if s.id == song.id:
-                return s
-        raise QueueError()
+        entry = self.find(song.id)
+        if entry is None:
+            raise QueueError()
+        return to_song(entry)
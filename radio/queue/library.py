@@ -0,0 +1,344 @@
+from __future__ import absolute_import
+import collections
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import mutagen
+
+
+logger = logging.getLogger("radio.queue")
+
+# A track in the library, `length` is None for files without usable tags.
+Track = collections.namedtuple("Track", ("songid", "mtime", "size", "length",
+                                         "metadata", "artist"))
+# Indexes saved before artists were kept have no artist.
+Track.__new__.__defaults__ = (None,)
+
+
+def read_tags(item):
+    """
+    Returns (path, mtime, size, length, metadata, artist) for a (path,
+    mtime, size) tuple, the tags are None if the file can't be read.
+
+    This runs in the worker processes of `Library.scan`.
+    """
+    path, mtime, size = item
+    try:
+        meta = mutagen.File(path, easy=True)
+    except Exception:
+        meta = None
+
+    if not meta:
+        return path, mtime, size, None, None, None
+
+    artist = u", ".join(meta.get('artist', []))
+    title = u", ".join(meta.get('title', []))
+
+    if artist:
+        metadata = u"{artist:s} - {title:s}".format(artist=artist, title=title)
+    else:
+        metadata = title
+
+    return path, mtime, size, int(meta.info.length), metadata, artist or None
+
+
+def walk(directory):
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            yield os.path.join(root, filename)
+
+
+class Library(object):
+    """
+    An index of the tracks below `root`, stored in the file `path`.
+
+    Tracks are keyed by their path and only read again when their mtime or
+    size changed, so a scan of an unchanged library is a walk and a stat of
+    every file. Tags are read by a pool of `processes` processes.
+
+    Tracks are picked by `selector`, `played` records their plays.
+    """
+    # Amount of newly read tracks after which the index is saved during a
+    # scan, so an interrupted scan doesn't have to start over.
+    checkpoint = 1000
+
+    def __init__(self, root, path, serializer, selector, processes=None):
+        super(Library, self).__init__()
+        self.root = root
+        self.path = path
+        self.serializer = serializer
+        self.selector = selector
+        self.processes = processes
+
+        self.lock = threading.Lock()
+        # Held during a step of the running `scanning` Scan.
+        self.scan_lock = threading.Lock()
+        self.scanning = None
+        # path => Track
+        self.tracks = {}
+        # songid => path
+        self.songids = {}
+        self.next_songid = 1
+        # Set when the index changed since it was last saved.
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.selector)
+
+    def get(self, songid):
+        """
+        Returns (path, Track) of `songid`, or None.
+        """
+        with self.lock:
+            path = self.songids.get(songid)
+            if path is None:
+                return None
+            return path, self.tracks[path]
+
+    def add(self, path, mtime, size, length, metadata, artist=None):
+        """
+        Adds or updates the track at `path`.
+        """
+        with self.lock:
+            old = self.tracks.get(path)
+            if old is None:
+                songid = self.next_songid
+                self.next_songid += 1
+            else:
+                songid = old.songid
+
+            track = Track(songid, mtime, size, length, metadata, artist)
+            self._insert(path, track)
+
+            if length is None:
+                self.selector.discard(songid)
+            else:
+                self.selector.update(songid, artist=artist)
+
+    def discard(self, path):
+        """
+        Removes the track at `path`, if any.
+        """
+        with self.lock:
+            track = self.tracks.pop(path, None)
+            if track is None:
+                return
+
+            del self.songids[track.songid]
+            self.selector.discard(track.songid)
+            self.dirty = True
+
+    def update(self, path):
+        """
+        Brings the track at `path` up to date with the file, directories
+        are updated recursively.
+        """
+        if os.path.isdir(path):
+            for filepath in walk(path):
+                self.update(filepath)
+            return
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.remove(path)
+            return
+
+        with self.lock:
+            track = self.tracks.get(path)
+        if track is None or (track.mtime, track.size) != (stat.st_mtime, stat.st_size):
+            self.add(*read_tags((path, stat.st_mtime, stat.st_size)))
+
+    def remove(self, path):
+        """
+        Removes the track at `path`, or every track below it if it was a
+        directory.
+        """
+        with self.lock:
+            if path in self.tracks:
+                paths = [path]
+            else:
+                prefix = os.path.join(path, '')
+                paths = [track for track in self.tracks if track.startswith(prefix)]
+
+        for track in paths:
+            self.discard(track)
+
+    def _insert(self, path, track):
+        self.dirty = True
+        self.tracks[path] = track
+        self.songids[track.songid] = path
+
+    def pick(self, amount, exclude=()):
+        """
+        Returns up to `amount` (path, Track) picked by the selector, none of
+        them with a songid in `exclude`.
+        """
+        picks = []
+        for songid in self.selector.sample(amount, exclude):
+            track = self.get(songid)
+            if track is not None:
+                picks.append(track)
+
+        if picks:
+            # The play history is part of the index.
+            self.dirty = True
+        return picks
+
+    def played(self, songid):
+        """
+        Records a play of `songid`.
+        """
+        self.selector.played(songid)
+        self.dirty = True
+
+    def load(self):
+        """
+        Loads the index saved by `save`, returns False if there was none.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = self.serializer.loads(f.read())
+        except (IOError, ValueError):
+            return False
+
+        with self.lock:
+            for path, fields in data["tracks"].items():
+                self._insert(path, Track(*fields))
+
+            self.next_songid = data["next_songid"]
+            self.dirty = False
+
+            history = data.get("history", {})
+            tracks = []
+            for track in self.tracks.values():
+                if track.length is None:
+                    continue
+                lastplayed, lastrequested, plays = history.get(str(track.songid), (0, 0, 0))
+                tracks.append((track.songid, track.artist, lastplayed, lastrequested, plays))
+
+        self.selector.reset(tracks)
+
+        logger.info("loaded library index of %d tracks", len(self.tracks))
+        return True
+
+    def save(self):
+        """
+        Saves the index, the file is replaced atomically.
+        """
+        with self.lock:
+            data = {
+                "tracks": {path: list(track) for path, track in self.tracks.items()},
+                "history": self.selector.history(),
+                "next_songid": self.next_songid,
+            }
+            self.dirty = False
+
+        temporary = self.path + ".tmp"
+        with open(temporary, 'wb') as f:
+            f.write(self.serializer.dumps(data))
+        os.rename(temporary, self.path)
+
+    def scan(self):
+        """
+        Brings the index up to date with the files below `root`.
+        """
+        while not self.scan_step():
+            pass
+
+    def scan_step(self, files=None, seconds=None):
+        """
+        Continues the running scan, or starts a new one, for at most
+        `files` files or `seconds` seconds of walking. Returns True once
+        the scan is complete.
+
+        Tags are read for the changed files of each step, so `files` also
+        bounds the amount of tags read.
+        """
+        with self.scan_lock:
+            if self.scanning is None:
+                self.scanning = Scan(self.root)
+            scan = self.scanning
+
+            deadline = None if seconds is None else time.time() + seconds
+            changed = []
+            complete = True
+
+            for count, path in enumerate(scan.files, 1):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                scan.seen.add(path)
+                with self.lock:
+                    track = self.tracks.get(path)
+
+                if track is None or (track.mtime, track.size) != (stat.st_mtime, stat.st_size):
+                    changed.append((path, stat.st_mtime, stat.st_size))
+
+                if ((files is not None and count >= files) or
+                        (deadline is not None and time.time() >= deadline)):
+                    complete = False
+                    break
+
+            try:
+                if changed:
+                    self.read(scan, changed)
+
+                if not complete:
+                    return False
+
+                with self.lock:
+                    removed = set(self.tracks) - scan.seen
+                for path in removed:
+                    self.discard(path)
+
+                self.save()
+            except:
+                scan.close()
+                self.scanning = None
+                raise
+
+            scan.close()
+            self.scanning = None
+
+        logger.info("scanned library in %.3fs: %d tracks, %d read, %d removed",
+                    time.time() - scan.start, len(self.tracks), scan.read, len(removed))
+        return True
+
+    def read(self, scan, items):
+        """
+        Reads the tags of the (path, mtime, size) `items` and adds them.
+        """
+        if scan.pool is None:
+            scan.pool = multiprocessing.Pool(self.processes)
+
+        for result in scan.pool.imap_unordered(read_tags, items, chunksize=64):
+            self.add(*result)
+            scan.read += 1
+            if scan.read % self.checkpoint == 0:
+                self.save()
+
+
+class Scan(object):
+    """
+    The progress of a `Library` scan.
+    """
+    def __init__(self, root):
+        super(Scan, self).__init__()
+        self.files = walk(root)
+        self.seen = set()
+        self.read = 0
+        self.start = time.time()
+        # Tag reading processes, started on the first changed file.
+        self.pool = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,183 @@
+from __future__ import absolute_import
+import bisect
+import functools
+import threading
+import time
+
+
+# Upper bounds in seconds of the histogram buckets.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram(object):
+    """
+    Counts observed values per bucket, `buckets` are the upper bounds.
+    """
+    def __init__(self, buckets=BUCKETS):
+        super(Histogram, self).__init__()
+        self.buckets = buckets
+        # The last count is for values above the largest bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def stats(self):
+        """
+        Returns the count, sum and cumulative [upper bound, count] buckets,
+        the last bound is "+Inf".
+        """
+        bounds = list(self.buckets) + ["+Inf"]
+        buckets, total = [], 0
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            buckets.append([bound, total])
+
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class Metrics(object):
+    """
+    Call counts, errors, latencies and lock waits by function name.
+
+    Nothing is recorded until `enable` is called, and only functions
+    wrapped with `timed` and locks wrapped with `TimedLock` are measured,
+    so there is no overhead at all while disabled.
+    """
+    def __init__(self):
+        super(Metrics, self).__init__()
+        self.enabled = False
+        self.buckets = BUCKETS
+        self.lock = threading.Lock()
+        # name => {"calls", "errors", "latency", "lock_wait"}
+        self.functions = {}
+        # Name of the timed function running on each thread.
+        self.local = threading.local()
+
+    def enable(self, buckets=None):
+        self.enabled = True
+        self.buckets = tuple(buckets or BUCKETS)
+
+    def function(self, name):
+        """
+        Returns the metrics of `name`, the metrics lock has to be held.
+        """
+        metrics = self.functions.get(name)
+        if metrics is None:
+            metrics = self.functions[name] = {
+                "calls": 0,
+                "errors": 0,
+                "latency": Histogram(self.buckets),
+                "lock_wait": Histogram(self.buckets),
+            }
+        return metrics
+
+    def timed(self, name, function):
+        """
+        Returns `function` wrapped to record its calls under `name`.
+        """
+        @functools.wraps(function)
+        def timed_call(*args, **kwargs):
+            outer = getattr(self.local, "name", None)
+            self.local.name = name
+            error = False
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                elapsed = time.time() - start
+                self.local.name = outer
+
+                with self.lock:
+                    metrics = self.function(name)
+                    metrics["calls"] += 1
+                    metrics["errors"] += error
+                    metrics["latency"].observe(elapsed)
+
+        return timed_call
+
+    def waited(self, seconds):
+        """
+        Records a lock wait for the timed function running on this thread.
+        """
+        name = getattr(self.local, "name", None) or "other"
+        with self.lock:
+            self.function(name)["lock_wait"].observe(seconds)
+
+    def stats(self):
+        with self.lock:
+            return {
+                name: {
+                    "calls": metrics["calls"],
+                    "errors": metrics["errors"],
+                    "latency": metrics["latency"].stats(),
+                    "lock_wait": metrics["lock_wait"].stats(),
+                }
+                for name, metrics in self.functions.items()
+            }
+
+    def prometheus(self, prefix="radio_queue"):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        stats = self.stats()
+        lines = []
+
+        for metric, kind, field in (("calls_total", "counter", "calls"),
+                                    ("errors_total", "counter", "errors")):
+            lines.append("# TYPE {0}_{1} {2}".format(prefix, metric, kind))
+            for name, metrics in sorted(stats.items()):
+                lines.append('{0}_{1}{{function="{2}"}} {3}'.format(
+                    prefix, metric, name, metrics[field]))
+
+        for metric, field in (("call_seconds", "latency"),
+                              ("lock_wait_seconds", "lock_wait")):
+            lines.append("# TYPE {0}_{1} histogram".format(prefix, metric))
+            for name, metrics in sorted(stats.items()):
+                histogram = metrics[field]
+                for bound, count in histogram["buckets"]:
+                    lines.append('{0}_{1}_bucket{{function="{2}",le="{3}"}} {4}'.format(
+                        prefix, metric, name, bound, count))
+                lines.append('{0}_{1}_sum{{function="{2}"}} {3!r}'.format(
+                    prefix, metric, name, histogram["sum"]))
+                lines.append('{0}_{1}_count{{function="{2}"}} {3}'.format(
+                    prefix, metric, name, histogram["count"]))
+
+        return "\n".join(lines) + "\n"
+
+
+class TimedLock(object):
+    """
+    Wraps `lock` to record the time spent waiting to acquire it in
+    `metrics`.
+    """
+    def __init__(self, lock, metrics):
+        super(TimedLock, self).__init__()
+        self.lock = lock
+        self.metrics = metrics
+
+    def acquire(self, blocking=True):
+        start = time.time()
+        acquired = self.lock.acquire(blocking)
+        self.metrics.waited(time.time() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, extype, exvalue, traceback):
+        self.release()
+
+
+# Metrics of this process, shared by every queue.
+metrics = Metrics()
@@ -1,27 +1,24 @@
 from __future__ import absolute_import
-import Queue
+import functools
+import itertools
+import threading
 import os.path
 import time
-import random
 
 import MySQLdb as mysql
 import MySQLdb.cursors
 
-from .server import create_entry, register_backend
-
-
-RANDOM_SELECT_ADVANCED = """
-SELECT temp.id, temp.path, temp.len, temp.meta FROM (
-    (SELECT tracks.id, tracks.path, esong.len, esong.meta FROM tracks
-        JOIN esong ON tracks.hash = esong.hash WHERE usable=1 ORDER BY
-        (UNIX_TIMESTAMP(lastplayed) + 1)*(UNIX_TIMESTAMP(lastrequested) + 1)
-        ASC LIMIT 100)
-    UNION ALL
-    (SELECT tracks.id, tracks.path, esong.len, esong.meta FROM tracks
-        JOIN esong ON tracks.hash = esong.hash WHERE usable=1 ORDER BY
-        LEAST(lastplayed, lastrequested)
-        ASC LIMIT 100)
-) AS temp GROUP BY temp.id HAVING count(*) >= 2;
+from .cache import Cache
+from .pool import Pool, PoolTimeout, pools
+from .selection import create_selector, fill_queue
+from .server import Entry, register_backend, logger
+from .worker import Tasks
+
+
+TRACK_WEIGHTS = """
+SELECT tracks.id, tracks.artist, UNIX_TIMESTAMP(tracks.lastplayed),
+UNIX_TIMESTAMP(tracks.lastrequested), tracks.requestcount
+FROM tracks WHERE usable=1;
 """
 
 RANDOM_SELECT = """
@@ -34,196 +31,538 @@ LIMIT 100;
 """
 
 LR_UPDATE = """
-UPDATE tracks SET lastrequested=NOW() WHERE id=%s;
+UPDATE tracks SET lastrequested=NOW() WHERE id IN (%s);
 """
 
 LOAD_QUEUE = """
-SELECT trackid, meta, length, type FROM `queue` ORDER BY `id` ASC;
+SELECT queue.id, queue.trackid, queue.meta, queue.length, queue.type,
+tracks.path, esong.len, esong.meta FROM `queue`
+LEFT JOIN tracks ON tracks.id = queue.trackid
+LEFT JOIN esong ON tracks.hash = esong.hash
+ORDER BY queue.id ASC;
 """
 
-LOAD_PATH = """
-SELECT path FROM `tracks` WHERE `id`=%s;
+COUNT_QUEUE = """
+SELECT COUNT(*) FROM `queue`;
 """
 
 DELETE_QUEUE = """
-DELETE FROM `queue`;
+DELETE FROM `queue` WHERE `id` IN (%s);
 """
 
-INSERT_QUEUE = """
+# The VALUES list is expanded to one QUEUE_ROW per changed row, existing
+# rows are updated in place through their primary key.
+UPSERT_QUEUE = """
 INSERT INTO queue (trackid, time, ip, type, meta, length, id)
-VALUES (%s, from_unixtime(%s), NULL, %s, %s, %s, %s);
+VALUES %s
+ON DUPLICATE KEY UPDATE trackid=VALUES(trackid), time=VALUES(time),
+type=VALUES(type), meta=VALUES(meta), length=VALUES(length);
 """
 
+QUEUE_ROW = "(%s, from_unixtime(%s), NULL, %s, %s, %s, %s)"
+
 EXPAND = """
 SELECT tracks.path, esong.len, esong.meta FROM
 tracks JOIN esong ON tracks.hash = esong.hash
 WHERE tracks.id=%s;
 """
 
-def cursor_factory(**factory_options):
+EXPAND_MANY = """
+SELECT tracks.id, tracks.path, esong.len, esong.meta FROM
+tracks JOIN esong ON tracks.hash = esong.hash
+WHERE tracks.id IN (%s);
+"""
+
+# (catalog, songid) => (path, len, meta) of the track, or None if it
+# doesn't exist. Shared by every queue using this backend, the catalog is
+# the name of the primary pool of a queue.
+expand_cache = Cache("mysql.expand", maxsize=4096, ttl=3600)
+# Cache misses are looked up here, outside of the queue lock.
+expand_tasks = Tasks("radio.queue.mysql.expand")
+
+# Selection weights of the queues are reloaded here.
+selection_tasks = Tasks("radio.queue.mysql.selection")
+
+MISSING = object()
+
+def connect(**options):
+    conn = mysql.connect(**options)
+    conn.autocommit(False)
+    return conn
+
+
+def find_pool(options, lazy=False):
+    """
+    Returns the connection pool for the connect `options`, pool settings
+    are taken from the "pool" key. Queues with the same options share it.
+
+    A `lazy` pool opens no connections until they're needed.
+    """
+    options = dict(options)
+    settings = dict(options.pop("pool", {}))
+    if lazy:
+        settings["minsize"] = 0
+    options.pop("replicas", None)
+    options.pop("replica_retry", None)
+    name = "mysql://{0}@{1}:{2}/{3}".format(
+        options.get("user", ""), options.get("host", "localhost"),
+        options.get("port", 3306), options.get("db", ""))
+
+    pool = pools.get(name)
+    if pool is None:
+        pool = Pool(name, lambda: connect(**options), **settings)
+    return pool
+
+
+def find_replicas(options, primary):
+    """
+    Returns the pool to send read-only queries to. That's a ReplicaSet of
+    the "replicas" in `options`, each of them a dictionary of connect
+    options that override the primary ones, or `primary` without them.
+
+    Replica pools are lazy, so a replica that is down doesn't keep the
+    queue from loading.
+    """
+    replicas = options.get("replicas")
+    if not replicas:
+        return primary
+
+    pools = []
+    for replica in replicas:
+        merged = dict(options)
+        merged.update(replica)
+        pools.append(find_pool(merged, lazy=True))
+
+    return ReplicaSet(pools, primary, retry_after=options.get("replica_retry", 30))
+
+
+class ReplicaSet(object):
+    """
+    Hands out connections of the replica `pools` in turn, and connections
+    of `primary` when none of them can be reached.
+
+    A replica that can't be connected to is skipped for `retry_after`
+    seconds, one that is only busy is just skipped this time.
+    """
+    def __init__(self, pools, primary, retry_after=30):
+        super(ReplicaSet, self).__init__()
+        self.pools = pools
+        self.primary = primary
+        self.retry_after = retry_after
+
+        self.lock = threading.Lock()
+        self.turns = itertools.count()
+        # pool name => time it last failed
+        self.failures = {}
+        # id(connection) => pool it came from
+        self.owners = {}
+
+    def acquire(self):
+        start = next(self.turns)
+        for index in range(len(self.pools)):
+            pool = self.pools[(start + index) % len(self.pools)]
+            if time.time() - self.failures.get(pool.name, 0) < self.retry_after:
+                continue
+
+            try:
+                connection = pool.acquire()
+            except PoolTimeout:
+                logger.info("%s: replica busy", pool.name)
+                continue
+            except mysql.Error:
+                logger.warning("%s: replica unavailable", pool.name, exc_info=True)
+                self.failed(pool)
+                continue
+
+            return self.owned(connection, pool)
+
+        return self.owned(self.primary.acquire(), self.primary)
+
+    def release(self, connection, broken=False):
+        with self.lock:
+            pool = self.owners.pop(id(connection))
+
+        if broken and pool is not self.primary:
+            self.failed(pool)
+        pool.release(connection, broken)
+
+    def owned(self, connection, pool):
+        with self.lock:
+            self.owners[id(connection)] = pool
+        return connection
+
+    def failed(self, pool):
+        with self.lock:
+            self.failures[pool.name] = time.time()
+
+
+def cursor_factory(pool):
     def cursor(**options):
-        options.update(factory_options)
-        return Cursor(**options)
+        return Cursor(pool, **options)
     return cursor
 
+def refresh(queue):
+    """
+    Reloads the tracks and selection weights of `queue` from the database.
+    """
+    start = time.time()
+    with queue.read_cursor() as cur:
+        cur.execute(TRACK_WEIGHTS)
+        rows = cur.fetchall()
+
+    queue.selector.reset(
+        (trackid, artist, float(lastplayed or 0), float(lastrequested or 0), plays or 0)
+        for trackid, artist, lastplayed, lastrequested, plays in rows)
+
+    logger.debug("loaded selection weights of %d tracks in %.3fs",
+                 len(rows), time.time() - start)
+
+    # Catch up on a populate that ran short before the weights were loaded.
+    queue.worker.populate()
+
+
+def lookup_many(queue, songids):
+    """
+    Returns songid => (path, len, meta) of the tracks in `songids` that
+    exist, from `expand_cache` or with a single query.
+    """
+    tracks, unknown = {}, []
+    for songid in songids:
+        track = expand_cache.get((queue.catalog, songid), MISSING)
+        if track is MISSING:
+            unknown.append(songid)
+        elif track is not None:
+            tracks[songid] = track
+
+    if unknown:
+        with queue.read_cursor() as cur:
+            cur.execute(EXPAND_MANY % ','.join(["%s"] * len(unknown)), unknown)
+            for trackid, path, length, meta in cur.fetchall():
+                tracks[trackid] = (path, length, meta)
+
+        for songid in unknown:
+            expand_cache.set((queue.catalog, songid), tracks.get(songid))
+
+    return tracks
+
+
 def populate(queue):
     """
     Populates any missing entries in the queue.
     """
     queue.last_pop = time.time()
 
-    with queue.lock:
-        randoms = sum(not bool(entry.request) for entry in queue)
-        reqs = sum(bool(entry.request) for entry in queue)
-        threshold = (10 - min(reqs, 10)) / 2
+    if queue.selector.stale():
+        selection_tasks.submit(refresh, queue)
 
-        if randoms >= threshold:
-            return
+    fill_queue(queue, queue.selector, functools.partial(entries, queue),
+               functools.partial(requested, queue))
 
-        # ids = [entry.songid for entry in queue]
-        # ids.append(0) # ensure that there is an entry in the list
 
-        with queue.cursor() as cur:
-            cur.execute(RANDOM_SELECT_ADVANCED)
-            # cur.execute(RANDOM_SELECT % ','.join(["%s"] * len(ids)), ids)
+def entries(queue, songids):
+    """
+    Returns songid => Entry of the tracks in `songids` that exist.
+    """
+    found = {}
+    for trackid, (path, length, meta) in lookup_many(queue, songids).items():
+        entry = Entry(
+            songid=trackid,
+            length=length,
+            metadata=meta,
+            filename=os.path.join(queue.config['music_root'], path),
+            request=False,
+        )
+        # Everything `expand` would look up is already here.
+        entry._expanded = True
+        found[trackid] = entry
+    return found
+
+
+def requested(queue, songids):
+    with queue.cursor() as cur:
+        cur.execute(LR_UPDATE % ','.join(["%s"] * len(songids)), songids)
 
-            all = list(cur.fetchall())
-            for i in range(threshold - randoms): # add up to threshold entries
-                trackid, path, length, meta = all.pop(random.randint(0, len(all)-1))
-                cur.execute(LR_UPDATE, (trackid,))
 
-                entry = create_entry(
-                    songid=trackid,
-                    length=length,
-                    metadata=meta,
-                    filename=os.path.join(queue.config['music_root'], path),
-                    request=False,
-                )
+def row(entry, time):
+    """
+    Returns the `queue` table columns (minus the id) for `entry`.
+    """
+    return (entry.songid, time, '1' if entry.request else '0',
+            entry.metadata, entry.length)
 
-                queue.append(entry)
 
 def save(queue):
     """
     Saves the queue.
-    """
-    time_acc = queue.next_song_estimate
 
-    with queue.cursor() as cur:
-        cur.execute(DELETE_QUEUE)
+    Only rows that changed since the last save are written. The queue
+    lock is held just long enough to take a snapshot of the entries.
+    """
+    with queue.save_lock:
         with queue.lock:
-            for i, entry in enumerate(queue):
-                cur.execute(INSERT_QUEUE, (
-                    entry.songid, int(time_acc),
-                    '1' if entry.request else '0', entry.metadata,
-                    entry.length, i+1))
-                time_acc = time_acc + entry.length
+            snapshot = [(entry, row(entry, int(queue.estimate(entry))))
+                        for entry in queue]
+
+        # Entries are matched by identity; everything in `persisted` is
+        # kept alive by it so ids can't be reused in between.
+        known = {id(entry): (rowid, old)
+                 for entry, rowid, old in queue.persisted}
+
+        persisted, changed, deleted = [], [], []
+        last_rowid = 0
+        for entry, new in snapshot:
+            rowid, old = known.pop(id(entry), (None, None))
+
+            # Rows are loaded in id order, an entry that moved in front
+            # of another one needs a new id to keep its position.
+            # The row is written again under its new id.
+            if rowid is not None and rowid <= last_rowid:
+                deleted.append(rowid)
+                rowid = old = None
+
+            if rowid is None:
+                rowid = queue.next_rowid
+                queue.next_rowid += 1
+
+            if new != old:
+                changed.append(new + (rowid,))
+
+            persisted.append((entry, rowid, new))
+            last_rowid = rowid
+
+        deleted.extend(rowid for rowid, _ in known.itervalues())
+
+        if deleted or changed:
+            with queue.cursor() as cur:
+                if deleted:
+                    cur.execute(DELETE_QUEUE % ','.join(["%s"] * len(deleted)),
+                                deleted)
+                if changed:
+                    cur.execute(UPSERT_QUEUE % ','.join([QUEUE_ROW] * len(changed)),
+                                [value for values in changed for value in values])
+
+        queue.persisted = persisted
 
 def load(queue):
     """
     Populates `queue` with a previous save.
     """
-    queue.cursor = cursor_factory(**queue.config.get("mysql", {}))
+    options = queue.config.get("mysql", {})
+    primary = find_pool(options)
+    # Writes and reads of the queue table go to the primary, reads of the
+    # track catalog can go to replicas.
+    queue.cursor = cursor_factory(primary)
+    queue.catalog = primary.name
+    queue.read_cursor = cursor_factory(find_replicas(options, primary))
     queue.last_pop = time.time()
+    queue.save_lock = threading.Lock()
+    queue.persisted = []
+    queue.next_rowid = 1
+    queue.selector = create_selector(queue.config)
 
+    cache = queue.config.get("expand_cache", {})
+    expand_cache.maxsize = cache.get("maxsize", expand_cache.maxsize)
+    expand_cache.ttl = cache.get("ttl", expand_cache.ttl)
+
+    start = time.time()
     with queue.cursor() as cur:
         cur.execute(LOAD_QUEUE)
-        for trackid, meta, length, type in cur:
+        rows = cur.fetchall()
+
+    for rowid, trackid, meta, length, type, path, track_length, track_meta in rows:
+        queue.next_rowid = max(queue.next_rowid, rowid + 1)
+
+        if path is None:
+            # did not find the song in DB; skip this entry and
+            # use a placeholder so the row is deleted on save.
+            queue.persisted.append((object(), rowid, None))
+            continue
+
+        expand_cache.set((queue.catalog, trackid), (path, track_length, track_meta))
+
+        entry = Entry(
+            songid=trackid,
+            metadata=meta or track_meta,
+            length=length or track_length,
+            request= type == 1,
+            filename=os.path.join(queue.config.get('music_root', ''), path),
+        )
+        # Everything `expand` would look up is already here.
+        entry._expanded = True
 
-            with queue.cursor() as cur2:
-                cur2.execute(LOAD_PATH, (trackid,))
-                if cur2.rowcount == 1:
-                    path, = cur2.fetchone()
+        with queue.lock:
+            queue.append(entry)
+            entry = queue[-1]
+
+        # The stored time is unknown here, it gets updated on save.
+        queue.persisted.append((entry, rowid, row(entry, None)))
+
+    logger.info("loaded %d of %d queue rows in %.3fs",
+                len(queue), len(rows), time.time() - start)
+
+    # Load the selection weights up front, populate never selects by itself.
+    refresh(queue)
 
-                    filename = os.path.join(queue.config.get('music_root', ''), path)
-                else:
-                    # did not find the song in DB; skip this entry
-                    # logging?
-                    continue
 
-            entry = create_entry(
-                songid=trackid,
-                metadata=meta,
-                length=length,
-                request= type == 1,
-                filename=filename,
-            )
+def lookup(queue, songid):
+    """
+    Returns the (path, len, meta) of a track from the database, or None if
+    it doesn't exist. The result is stored in `expand_cache`.
+    """
+    with queue.read_cursor() as cur:
+        cur.execute(EXPAND, (songid,))
+        track = cur.fetchone()
+
+    expand_cache.set((queue.catalog, songid), track)
+    return track
+
+
+def fill(queue, entry, track):
+    """
+    Fills in any missing fields of `entry` from a `lookup` result.
+    """
+    if track is None:
+        return
+
+    path, length, meta = track
+    if not entry.filename:
+        entry.filename = os.path.join(queue.config.get('music_root', ''), path)
+    if not entry.length:
+        entry.length = length
+    if not entry.metadata:
+        entry.metadata = meta
+
+
+def enrich(queue, entry):
+    """
+    Looks up the track of an entry that is already in the queue. If that
+    fails the entry stays unexpanded and `usable` tries again when it's
+    about to be popped.
+    """
+    try:
+        track = lookup(queue, entry.songid)
+    except Exception:
+        logger.exception("looking up track %s failed", entry.songid)
+        return
+
+    with queue.lock:
+        if entry._expanded:
+            return
+
+        length = entry.length
+        fill(queue, entry, track)
+        entry._expanded = True
+        if entry.length != length:
+            queue.reindex("update", entry)
+        else:
+            queue.changed("update", entry)
 
-            with queue.lock:
-                queue.append(entry)
+    queue.worker.save()
 
 
 def expand(queue, entry):
-    if not entry.songid:
+    """
+    Fills in the track information of `entry`.
+
+    This is called with the queue lock held, so it never waits on the
+    database: on a cache miss the entry is returned as is and filled in
+    by a background thread.
+    """
+    if not entry.songid or entry._expanded:
         return entry
 
-    with queue.cursor() as cur:
-        cur.execute(EXPAND, (entry.songid,))
+    if entry.filename and entry.length and entry.metadata:
+        entry._expanded = True
+        return entry
 
-        for path, length, meta in cur:
-            if not entry.filename:
-                entry.filename = os.path.join(queue.config.get('music_root', ''), path)
-            if not entry.length:
-                entry.length = length
-            if not entry.metadata:
-                entry.metadata = meta
+    track = expand_cache.get((queue.catalog, entry.songid), MISSING)
+    if track is MISSING:
+        expand_tasks.submit(enrich, queue, entry)
+    else:
+        fill(queue, entry, track)
+        entry._expanded = True
 
     return entry
 
 
+def usable(queue, entry):
+    """
+    Returns True if `entry` has a file to play. An entry that was never
+    filled in because its lookup failed is looked up once more, and dropped
+    if that fails too.
+    """
+    if entry.songid and not entry._expanded:
+        try:
+            track = lookup(queue, entry.songid)
+        except Exception:
+            logger.exception("looking up track %s failed", entry.songid)
+            return False
+
+        length = entry.length
+        fill(queue, entry, track)
+        entry._expanded = True
+        if entry.length != length:
+            queue.reindex("update", entry)
+
+    return bool(entry.filename)
+
+
 def length(queue):
     with queue.cursor() as cur:
-        cur.execute(LOAD_QUEUE)
-        return cur.rowcount
+        cur.execute(COUNT_QUEUE)
+        count, = cur.fetchone()
+        return count
 
-register_backend("mysql", save, load, populate, expand, length)
+def played(queue, entry):
+    """
+    Lowers the selection weight of a popped track right away, the database
+    catches up on the next `refresh`.
+    """
+    queue.selector.played(entry.songid)
+
+register_backend("mysql", save, load, populate, expand, length, usable, played)
 
 
 class Cursor(object):
     """
-    Establishes a connection to the database and returns an open cursor.
+    Returns an open cursor on a connection from `pool`.
 
+    The transaction is committed when the with block ends and rolled back
+    if it raised.
 
     ```python
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(pool) as cur:
     cur.execute(query)
     ```
     """
-    _cache = Queue.Queue(maxsize=5)
-
-    def __init__(self, cursor_type=mysql.cursors.Cursor, **options):
+    def __init__(self, pool, cursor_type=mysql.cursors.Cursor):
         super(Cursor, self).__init__()
-
-        try:
-            conn = self._cache.get_nowait()
-        except Queue.Empty:
-            conn = mysql.connect(**options)
-        else:
-            # Ping the connection before using it from the cache.
-            conn.ping(True)
-
-        self.conn = conn
-        self.conn.autocommit(False)
+        self.pool = pool
         self.cursor_type = cursor_type
 
-    @classmethod
-    def clear_cache(cls):
-        cls._cache = Queue.Queue(maxsize=5)
-
     def __enter__(self):
-        self.cursor = self.conn.cursor(self.cursor_type)
+        self.conn = self.pool.acquire()
+        try:
+            self.cursor = self.conn.cursor(self.cursor_type)
+        except:
+            self.pool.release(self.conn, broken=True)
+            raise
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a MySQL related error we try to rollback the cursor.
-        if extype is mysql.MySQLError:
-            self.cursor.rollback()
-
-        self.cursor.close()
-        self.conn.commit()
-
-        # Put it back on the queue
         try:
-            self._cache.put_nowait(self.conn)
-        except Queue.Full:
-            self.conn.close()
+            self.cursor.close()
+            if extype is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        except Exception:
+            self.pool.release(self.conn, broken=True)
+            if extype is None:
+                raise
+            # The original exception is more useful, it's raised instead.
+            logger.exception("rollback failed")
+        else:
+            # The connection is gone after these, don't reuse it.
+            self.pool.release(self.conn, broken=isinstance(exvalue, mysql.OperationalError))
@@ -0,0 +1,197 @@
+from __future__ import absolute_import
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger("radio.queue")
+
+# All connection pools by name, for stats.
+pools = {}
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection became available in time.
+    """
+
+
+class Pool(object):
+    """
+    A bounded pool of connections made by `connect`.
+
+    At least `minsize` and at most `maxsize` connections are open, `acquire`
+    waits up to `timeout` seconds for a connection when all of them are in
+    use. Connections are only pinged when they were idle for more than
+    `check_after` seconds, and idle connections beyond `minsize` are closed
+    after `max_idle` seconds.
+    """
+    def __init__(self, name, connect, minsize=1, maxsize=5, timeout=10,
+                 check_after=30, max_idle=300):
+        super(Pool, self).__init__()
+        self.name = name
+        self.connect = connect
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+
+        self.condition = threading.Condition()
+        # (connection, time it was released), most recently released last
+        self.idle = []
+        # Open connections, including ones being connected.
+        self.size = 0
+
+        self.acquires = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.failed_checks = 0
+
+        pools[name] = self
+
+        for _ in range(minsize):
+            with self.condition:
+                self.size += 1
+            self.release(self.open())
+
+    def acquire(self):
+        """
+        Returns a connection, it has to be given back with `release`.
+        """
+        with self.condition:
+            self.acquires += 1
+
+            start = deadline = None
+            while not self.idle and self.size >= self.maxsize:
+                if deadline is None:
+                    start = time.time()
+                    deadline = start + self.timeout
+                    self.waits += 1
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self.wait_time += time.time() - start
+                    raise PoolTimeout("no connection available in {0} after {1}s".format(
+                        self.name, self.timeout))
+                self.condition.wait(remaining)
+
+            if start is not None:
+                self.wait_time += time.time() - start
+
+            if not self.idle:
+                # Reserve the place of the new connection.
+                self.size += 1
+                connection = None
+            else:
+                connection, released = self.idle.pop()
+
+        if connection is None:
+            return self.open()
+
+        if time.time() - released > self.check_after and not self.check(connection):
+            return self.open()
+
+        return connection
+
+    def release(self, connection, broken=False):
+        """
+        Gives a connection back, a `broken` connection is closed instead.
+        """
+        if broken:
+            self.discard(connection)
+            return
+
+        now = time.time()
+        expired = []
+        with self.condition:
+            self.idle.append((connection, now))
+
+            while (self.size > self.minsize and self.idle and
+                   now - self.idle[0][1] > self.max_idle):
+                expired.append(self.idle.pop(0)[0])
+                self.size -= 1
+
+            self.condition.notify()
+
+        for connection in expired:
+            close(connection)
+
+    def discard(self, connection):
+        """
+        Closes a connection that was acquired and frees its place.
+        """
+        close(connection)
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def open(self):
+        """
+        Returns a new connection in a place that was reserved in `size`.
+        """
+        try:
+            connection = self.connect()
+        except:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+        with self.condition:
+            self.connects += 1
+        return connection
+
+    def check(self, connection):
+        """
+        Returns True if `connection` still works, it's discarded if not.
+        """
+        try:
+            connection.ping()
+        except Exception:
+            logger.info("%s: dropping dead connection", self.name)
+            with self.condition:
+                self.failed_checks += 1
+            # The place is kept for the connection that replaces it.
+            close(connection)
+            return False
+        return True
+
+    def close(self):
+        """
+        Closes all idle connections and forgets the pool.
+        """
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+
+        for connection, _ in idle:
+            close(connection)
+
+        if pools.get(self.name) is self:
+            del pools[self.name]
+
+    def stats(self):
+        with self.condition:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "in_use": self.size - len(self.idle),
+                "maxsize": self.maxsize,
+                "acquires": self.acquires,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "failed_checks": self.failed_checks,
+            }
+
+
+def close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
@@ -3,6 +3,7 @@ import argparse
 import json
 
 from . import server
+from .serializer import serializers
 
 
 def jsonfile(filename):
@@ -16,11 +17,13 @@ parser.add_argument('--config', '-c', help="location of configuration file", typ
 parser.add_argument('--host', help="address to bind server listener on.", default="localhost", type=unicode)
 parser.add_argument('--port', help="port to use for the server listener.", default=9999, type=int)
 parser.add_argument('--backend', help="queue storage backend to use.", default="mysql", type=unicode)
+parser.add_argument('--engine', help="jsonrpc server implementation to use.", default="simple", choices=sorted(server.engines))
+parser.add_argument('--serializer', help="json implementation to use, defaults to the fastest installed.", default=None, choices=sorted(serializers))
 
 def main():
     args = parser.parse_args()
 
-    server.run_server(args.host, args.port, args.backend, args.config)
+    server.run_server(args.host, args.port, args.backend, args.config, args.engine, args.serializer)
 
 
 if __name__ == "__main__":
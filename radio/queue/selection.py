@@ -0,0 +1,366 @@
+from __future__ import absolute_import
+import collections
+import math
+import random
+import threading
+import time
+
+
+class FenwickTree(object):
+    """
+    A list of weights with O(log n) updates, prefix sums and weighted
+    searches.
+    """
+    def __init__(self, weights=()):
+        super(FenwickTree, self).__init__()
+        self.build(list(weights))
+
+    def build(self, weights):
+        """
+        Replaces all weights, in O(n).
+        """
+        self.weights = weights
+        self.tree = [0.0] + weights
+        size = len(weights)
+        for index in range(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                self.tree[parent] += self.tree[index]
+
+        self.top = 1
+        while self.top * 2 <= size:
+            self.top *= 2
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __getitem__(self, index):
+        return self.weights[index]
+
+    def __setitem__(self, index, weight):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def grow(self, size):
+        """
+        Adds weights of zero up to `size`, in O(n).
+        """
+        self.build(self.weights + [0.0] * (size - len(self.weights)))
+
+    def total(self):
+        """
+        Returns the sum of all weights.
+        """
+        total, index = 0.0, len(self.weights)
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def find(self, value):
+        """
+        Returns the first index at which the running sum of weights
+        exceeds `value`.
+        """
+        index, bit = 0, self.top
+        while bit:
+            following = index + bit
+            if following < len(self.tree) and self.tree[following] <= value:
+                index = following
+                value -= self.tree[following]
+            bit //= 2
+        return min(index, len(self.weights) - 1)
+
+
+class Selector(object):
+    """
+    Picks random tracks, weighted by how long ago they were last played or
+    requested and by how often they were played.
+
+    A track regains its full weight `cooldown` seconds after it was played
+    or requested. Picks avoid the artists of the last `artist_separation`
+    picks and the last `track_separation` picked tracks, these rules are
+    relaxed when nothing else is left.
+
+    Weights change with time, `stale` tells when they should be refreshed.
+    """
+    def __init__(self, cooldown=7 * 24 * 3600, artist_separation=10,
+                 track_separation=50, refresh=3600):
+        super(Selector, self).__init__()
+        self.cooldown = cooldown
+        self.refresh_interval = refresh
+
+        self.lock = threading.Lock()
+        self.tree = FenwickTree()
+        # songid => slot in the tree, and the reverse
+        self.slots = {}
+        self.songids = []
+        self.free = []
+        # songid => [artist, lastplayed, lastrequested, plays]
+        self.tracks = {}
+        self.refreshed = time.time()
+
+        self.recent_artists = collections.deque(maxlen=artist_separation)
+        self.recent_tracks = collections.deque(maxlen=track_separation)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def weight(self, lastplayed, lastrequested, plays, now):
+        age = now - max(lastplayed, lastrequested)
+        freshness = min(max(age / float(self.cooldown), 0.01), 1.0)
+        return freshness / math.sqrt(1 + plays)
+
+    def update(self, songid, artist=None, lastplayed=None, lastrequested=None,
+               plays=None):
+        """
+        Adds or updates a track, fields that are None are kept as they were.
+        """
+        with self.lock:
+            track = self.tracks.get(songid)
+            if track is None:
+                track = self.tracks[songid] = [None, 0, 0, 0]
+                self._claim(songid)
+
+            for field, value in enumerate((artist, lastplayed, lastrequested, plays)):
+                if value is not None:
+                    track[field] = value
+
+            self._reweight(songid, time.time())
+
+    def discard(self, songid):
+        """
+        Removes a track, if it exists.
+        """
+        with self.lock:
+            if self.tracks.pop(songid, None) is None:
+                return
+
+            slot = self.slots.pop(songid)
+            self.tree[slot] = 0.0
+            self.songids[slot] = None
+            self.free.append(slot)
+
+    def played(self, songid, when=None):
+        """
+        Marks a track as played at `when`, now by default.
+        """
+        with self.lock:
+            track = self.tracks.get(songid)
+            if track is None:
+                return
+
+            track[1] = when or time.time()
+            track[3] += 1
+            self._reweight(songid, time.time())
+
+    def reset(self, tracks):
+        """
+        Replaces all tracks with (songid, artist, lastplayed, lastrequested,
+        plays) `tracks`. The tree is built without holding the lock, so
+        picks can continue meanwhile.
+        """
+        now = time.time()
+        infos, songids, weights = {}, [], []
+        for songid, artist, lastplayed, lastrequested, plays in tracks:
+            infos[songid] = [artist, lastplayed or 0, lastrequested or 0, plays or 0]
+            songids.append(songid)
+            weights.append(self.weight(lastplayed or 0, lastrequested or 0, plays or 0, now))
+
+        tree = FenwickTree(weights)
+        slots = {songid: slot for slot, songid in enumerate(songids)}
+
+        with self.lock:
+            self.tree, self.tracks = tree, infos
+            self.slots, self.songids, self.free = slots, songids, []
+            self.refreshed = now
+
+    def refresh(self):
+        """
+        Recalculates every weight for the current time.
+        """
+        with self.lock:
+            tracks = [[songid] + track for songid, track in self.tracks.items()]
+        self.reset(tracks)
+
+    def stale(self):
+        """
+        Returns True once every `refresh` seconds, the caller should then
+        `refresh` the weights.
+        """
+        with self.lock:
+            now = time.time()
+            if now - self.refreshed <= self.refresh_interval:
+                return False
+            self.refreshed = now
+            return True
+
+    def history(self):
+        """
+        Returns songid => (lastplayed, lastrequested, plays) of every track.
+        """
+        with self.lock:
+            return {songid: tuple(track[1:]) for songid, track in self.tracks.items()}
+
+    def sample(self, amount, exclude=()):
+        """
+        Returns up to `amount` different songids, never any in `exclude`,
+        and marks them as requested.
+        """
+        now = time.time()
+        picks = []
+
+        with self.lock:
+            # Weights taken out while sampling, slot => weight
+            removed = {}
+            try:
+                for _ in range(amount):
+                    songid = self._pick(exclude, removed)
+                    if songid is None:
+                        break
+
+                    picks.append(songid)
+                    slot = self.slots[songid]
+                    removed[slot] = self.tree[slot]
+                    self.tree[slot] = 0.0
+
+                    artist = self.tracks[songid][0]
+                    self.recent_tracks.append(songid)
+                    if artist:
+                        self.recent_artists.append(artist)
+            finally:
+                for slot, weight in removed.items():
+                    self.tree[slot] = weight
+
+            for songid in picks:
+                self.tracks[songid][2] = now
+                self._reweight(songid, now)
+
+        return picks
+
+    def _pick(self, exclude, removed):
+        # Tracks that break a rule are taken out of the tree until the end
+        # of the sample, each rule is dropped in turn if nothing is left.
+        artists, tracks = set(self.recent_artists), set(self.recent_tracks)
+        rules = [(artists, tracks), ((), tracks), ((), ())]
+
+        for artists, tracks in rules:
+            rejected = {}
+            try:
+                while True:
+                    total = self.tree.total()
+                    if total <= 0:
+                        break
+
+                    slot = self.tree.find(random.random() * total)
+                    songid = self.songids[slot]
+                    if self.tree[slot] <= 0 or songid is None:
+                        # Rounding errors in the sums, start over.
+                        self.tree.build(self.tree.weights)
+                        continue
+
+                    artist = self.tracks[songid][0]
+                    if songid in exclude or songid in tracks or (artist and artist in artists):
+                        weight = self.tree[slot]
+                        if songid in exclude:
+                            removed[slot] = weight
+                        else:
+                            rejected[slot] = weight
+                        self.tree[slot] = 0.0
+                        continue
+
+                    return songid
+            finally:
+                for slot, weight in rejected.items():
+                    self.tree[slot] = weight
+
+        return None
+
+    def _claim(self, songid):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            # Growing rebuilds the tree, doubling its size keeps that rare.
+            slot = len(self.tree)
+            self.tree.grow(max(16, slot * 2))
+            self.songids.extend([None] * (len(self.tree) - slot))
+            self.free.extend(reversed(range(slot + 1, len(self.tree))))
+
+        self.songids[slot] = songid
+        self.slots[songid] = slot
+
+    def _reweight(self, songid, now):
+        _, lastplayed, lastrequested, plays = self.tracks[songid]
+        self.tree[self.slots[songid]] = self.weight(lastplayed, lastrequested, plays, now)
+
+
+def create_selector(config):
+    """
+    Returns a Selector set up from the `selection` section of `config`.
+    """
+    options = config.get("selection", {})
+    return Selector(
+        cooldown=options.get("cooldown", 7 * 24 * 3600),
+        artist_separation=options.get("artist_separation", 10),
+        track_separation=options.get("track_separation", 50),
+        refresh=options.get("refresh", 3600),
+    )
+
+
+def missing(queue):
+    """
+    Returns the amount of random entries `queue` is short, fewer are kept
+    while there are requests in it.
+    """
+    randoms = sum(not bool(entry.request) for entry in queue)
+    reqs = sum(bool(entry.request) for entry in queue)
+    threshold = (10 - min(reqs, 10)) / 2
+
+    return threshold - randoms
+
+
+def fill_queue(queue, selector, lookup, requested=None):
+    """
+    Appends the random entries `queue` is short, picked by `selector`, and
+    returns their songids.
+
+    `lookup(songids)` returns songid => Entry of the picked tracks that
+    still exist, the others are dropped from the selector. It runs without
+    holding the queue lock, so it can query a database. `requested` is
+    called with the songids of the appended entries, after the lock is
+    released.
+    """
+    with queue.lock:
+        amount = missing(queue)
+        if amount <= 0:
+            return []
+        picks = selector.sample(amount, exclude=queue.songs)
+
+    if not picks:
+        return []
+
+    entries = lookup(picks)
+
+    appended = []
+    with queue.lock:
+        # Entries appended during the lookup count as well.
+        amount = missing(queue)
+        for songid in picks:
+            entry = entries.get(songid)
+            if entry is None:
+                selector.discard(songid)
+                continue
+            if len(appended) >= amount:
+                break
+
+            queue.append(entry)
+            appended.append(songid)
+
+    if appended and requested is not None:
+        requested(appended)
+    return appended
@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+class Serializer(object):
+    """
+    Encodes and decodes JSON with the standard library.
+    """
+    name = "json"
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def encode(self, value):
+        """
+        Like `dumps`, but uses the JSON carried by `EncodedList` and
+        `EncodedDict` values instead of encoding them again.
+        """
+        encoded = getattr(value, "encoded", None)
+        if encoded is not None:
+            return encoded
+        return self.dumps(value)
+
+    def response(self, result, rpcid, version=2.0):
+        """
+        Returns a JSON RPC response for `result`.
+        """
+        if version >= 2:
+            return '{"jsonrpc":"2.0","id":%s,"result":%s}' % (
+                self.dumps(rpcid), self.encode(result))
+
+        return '{"id":%s,"error":null,"result":%s}' % (
+            self.dumps(rpcid), self.encode(result))
+
+
+class UJSONSerializer(Serializer):
+    name = "ujson"
+
+    def dumps(self, value):
+        return ujson.dumps(value, double_precision=15)
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+class SimpleJSONSerializer(Serializer):
+    name = "simplejson"
+
+    def dumps(self, value):
+        return simplejson.dumps(value, separators=(',', ':'))
+
+    def loads(self, data):
+        return simplejson.loads(data)
+
+
+# Serializers that can be used, in order of preference. name => Serializer
+serializers = {"json": Serializer()}
+preference = ["json"]
+
+if simplejson is not None:
+    serializers["simplejson"] = SimpleJSONSerializer()
+    preference.insert(0, "simplejson")
+
+if ujson is not None:
+    serializers["ujson"] = UJSONSerializer()
+    preference.insert(0, "ujson")
+
+
+def find_serializer(name=None):
+    """
+    Returns the serializer called `name`, or the fastest one available.
+    """
+    if name is None:
+        name = preference[0]
+    return serializers[name]
+
+
+class EncodedList(list):
+    """
+    A list that also carries its own JSON encoding in `encoded`.
+    """
+    def __init__(self, items, encoded):
+        super(EncodedList, self).__init__(items)
+        self.encoded = encoded
+
+
+class EncodedDict(dict):
+    """
+    A dictionary that also carries its own JSON encoding in `encoded`.
+    """
+    def __init__(self, items, encoded):
+        super(EncodedDict, self).__init__(items)
+        self.encoded = encoded
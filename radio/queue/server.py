@@ -1,14 +1,23 @@
 from __future__ import absolute_import
+import collections
 import functools
+import json
+import re
 import threading
 import time
 import logging
 import sys
 from collections import deque, namedtuple
 
-from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer as JSONServer
 import jsonrpclib
 
+from .cache import caches
+from .engine import Dispatcher, engines
+from .metrics import TimedLock, metrics
+from .pool import pools
+from .serializer import EncodedDict, EncodedList, find_serializer
+from .worker import Worker, WorkerGroup
+
 
 # setup logging, we use stdout
 logger = logging.getLogger("radio.queue")
@@ -17,42 +26,320 @@ logger.addHandler(logging.StreamHandler(sys.stderr))
 jsonrpclib.config.use_jsonclass = False
 
 api_functions = []
-Backend = namedtuple("Backend", ("save", "load", "populate", "expand", "length"))
+# API functions that wait for a long time, see `blocking`.
+blocking_functions = []
+Backend = namedtuple("Backend", ("save", "load", "populate", "expand", "length", "usable",
+                                 "played", "shutdown"))
+Snapshot = namedtuple("Snapshot", ("version", "entries", "encoded"))
 
 # We need a backend we can return at all times. This one always just does nothing.
 NOP = lambda *args, **kwargs: None
-NOP_BACKEND = Backend(save=NOP, load=NOP, populate=NOP, expand=NOP, length=NOP)
+NOP_BACKEND = Backend(save=NOP, load=NOP, populate=NOP, expand=NOP, length=NOP,
+                      usable=lambda queue, item: True, played=NOP, shutdown=NOP)
 
 # A dictionary of backends, name => Backend
 backends = {}
+# Names of the backends whose hooks are already timed by `metrics`.
+timed_backends = set()
 
+# Longest time in seconds a client can wait for a change in one call.
+MAX_WAIT = 60
 
-class Entry(dict):
-    _fields = ("songid", "length", "metadata", "filename", "request", "estimate")
+# Queue names are used as URL paths, these are taken by the server itself.
+QUEUE_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+RESERVED_NAMES = ("RPC2", "events", "metrics")
 
-    def __getattr__(self, key):
-        try:
-            return self[key]
-        except KeyError:
-            return super(Entry, self).__getattr__(key)
 
-    def __setattr__(self, key, value):
-        self[key] = value
+class Entry(object):
+    """
+    A single song in the queue.
+
+    Entries are sent to clients as plain dictionaries of the `_fields`,
+    see `to_wire` and `from_wire`. Attributes starting with an underscore
+    are queue bookkeeping and never leave the server.
+    """
+    __slots__ = ("songid", "length", "metadata", "filename", "request",
+                 "estimate", "_offset", "_position", "_expanded")
+    _fields = ("songid", "length", "metadata", "filename", "request", "estimate")
 
-    def __delattr__(self, key):
-        del self[key]
+    def __init__(self, songid=None, length=None, metadata=None,
+                 filename=None, request=None, estimate=None):
+        self.songid = songid
+        self.length = length
+        self.metadata = metadata
+        self.filename = filename
+        self.request = request
+        self.estimate = estimate
+        self._offset = 0
+        self._position = 0
+        self._expanded = False
+
+    @classmethod
+    def from_wire(cls, song):
+        """
+        Returns a new Entry from a dictionary, keys that aren't fields are
+        ignored.
+        """
+        get = song.get
+        return cls(get("songid"), get("length"), get("metadata"),
+                   get("filename"), get("request"), get("estimate"))
+
+    def to_wire(self):
+        """
+        Returns the fields of the entry as a dictionary.
+        """
+        return {
+            "songid": self.songid,
+            "length": self.length,
+            "metadata": self.metadata,
+            "filename": self.filename,
+            "request": self.request,
+            "estimate": self.estimate,
+        }
+
+    def __repr__(self):
+        return "Entry({0})".format(", ".join(
+            "{0}={1!r}".format(key, getattr(self, key)) for key in self._fields))
 
 
 # Inherit from deque here so we can add our own attributes to instances.
 class deque(deque):
-    def append(self, item):
-        item.estimate = self.next_song_estimate
-        for entry in self:
-            item.estimate += entry.length
+    """
+    The in-memory queue.
+
+    Every entry remembers the total length of the entries appended before
+    it (`_offset`), together with the total length of everything popped
+    from the front (`head_offset`) and the time at which the current head
+    starts playing (`next_song_estimate`), this gives the estimate of any
+    entry without having to walk the queue. Positions are tracked the same
+    way (`_position` and `head_position`), and `songs` maps every songid
+    to its entries in queue order.
+
+    Every change increments `version`, readers share an immutable
+    `snapshot` of the queue that is only rebuilt after a change. Changes
+    that clients care about are also kept as events, see `events_since`.
+    """
+    def __init__(self, *args, **kwargs):
+        super(deque, self).__init__(*args, **kwargs)
+        self.lock = threading.RLock()
+        self.serializer = find_serializer()
+        # Notified on every change, see `wait_for_change`.
+        self.condition = threading.Condition(threading.Lock())
+        self.version = 0
+        self.events = collections.deque(maxlen=256)
+        # Version of the newest event that no longer fits in `events`.
+        self.dropped_version = 0
+        self._snapshot = Snapshot(version=-1, entries=(), encoded=())
+        self.next_song_estimate = time.time()
+        self.reindex()
+
+    @property
+    def next_song_estimate(self):
+        return self._next_song_estimate
+
+    @next_song_estimate.setter
+    def next_song_estimate(self, value):
+        # Moves the estimate of every entry in the queue.
+        self._next_song_estimate = value
+        self.changed()
+
+    def changed(self, event=None, entry=None):
+        """
+        Marks the queue as changed, this has to be called after anything
+        that changes entries in place. If `event` is given, it is recorded
+        together with `entry`, which should be `estimated` already.
+        """
+        self.version += 1
+
+        if event is not None:
+            if len(self.events) == self.events.maxlen:
+                self.dropped_version = self.events[0]["version"]
+
+            if entry is not None:
+                entry = entry.to_wire()
+
+            self.events.append({
+                "version": self.version,
+                "type": event,
+                "entry": entry,
+            })
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def events_since(self, version):
+        """
+        Returns the events that happened after `version`, or None if some
+        of them are no longer known.
+        """
+        if version < self.dropped_version:
+            return None
+
+        with self.lock:
+            return [event for event in self.events if event["version"] > version]
+
+    def snapshot(self):
+        """
+        Returns a `Snapshot` of the current state of the queue, its entries
+        are dictionaries as sent to clients and `encoded` holds the JSON of
+        each of them.
+        """
+        snapshot = self._snapshot
+        if snapshot.version == self.version:
+            return snapshot
+
+        with self.lock:
+            entries = tuple(self.estimated(entry).to_wire() for entry in self)
+            encoded = tuple(self.serializer.dumps(entry) for entry in entries)
+            snapshot = Snapshot(version=self.version, entries=entries, encoded=encoded)
+            self._snapshot = snapshot
+
+        return snapshot
+
+    @property
+    def total_length(self):
+        return self.tail_offset - self.head_offset
+
+    def estimate(self, entry):
+        """
+        Returns the estimated time at which `entry` starts playing.
+        """
+        return self.next_song_estimate + entry._offset - self.head_offset
+
+    def estimated(self, entry):
+        """
+        Updates the `estimate` field of `entry` and returns it.
+        """
+        entry.estimate = self.estimate(entry)
+        return entry
 
+    def index(self, entry):
+        """
+        Returns the position of `entry` in the queue.
+        """
+        return entry._position - self.head_position
+
+    def find(self, songid):
+        """
+        Returns the first entry of `songid` in the queue, or None.
+        """
+        entries = self.songs.get(songid)
+        return entries[0] if entries else None
+
+    def reindex(self, event=None, entry=None):
+        """
+        Recalculates the offsets and positions of all entries, this is only
+        needed after operations that change the order or length of entries.
+        """
+        self.head_offset = self.tail_offset = 0
+        self.head_position = self.tail_position = 0
+        self.songs = {}
+        for item in self:
+            item._offset = self.tail_offset
+            item._position = self.tail_position
+            self.tail_offset += item.length or 0
+            self.tail_position += 1
+            self.songs.setdefault(item.songid, []).append(item)
+
+        self.changed(event, entry)
+
+    def forget(self, item, index):
+        """
+        Removes `item` from the entries of its songid at `index`.
+        """
+        entries = self.songs[item.songid]
+        del entries[index]
+        if not entries:
+            del self.songs[item.songid]
+
+    def append(self, item):
         item = find_backend(self.backend).expand(self, item)
 
+        item._offset = self.tail_offset
+        item._position = self.tail_position
+        self.tail_offset += item.length or 0
+        self.tail_position += 1
+        self.estimated(item)
+
         super(deque, self).append(item)
+        self.songs.setdefault(item.songid, []).append(item)
+        self.changed("append", item)
+
+    def appendleft(self, item):
+        self.head_offset -= item.length or 0
+        self.head_position -= 1
+        item._offset = self.head_offset
+        item._position = self.head_position
+        self.estimated(item)
+
+        super(deque, self).appendleft(item)
+        self.songs.setdefault(item.songid, []).insert(0, item)
+        self.changed("prepend", item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def popleft(self):
+        item = super(deque, self).popleft()
+        self.estimated(item)
+
+        self.head_offset = item._offset + (item.length or 0)
+        self.head_position = item._position + 1
+        self.forget(item, 0)
+        self.changed("pop", item)
+        return item
+
+    def pop(self):
+        item = super(deque, self).pop()
+        self.estimated(item)
+
+        self.tail_offset = item._offset
+        self.tail_position = item._position
+        self.forget(item, -1)
+        self.changed("remove", item)
+        return item
+
+    def remove(self, value):
+        self.estimated(value)
+
+        super(deque, self).remove(value)
+        self.reindex("remove", value)
+
+    def move(self, item, position):
+        """
+        Moves `item` to `position` in the queue.
+        """
+        super(deque, self).__delitem__(self.index(item))
+
+        position = max(0, min(position, len(self)))
+        super(deque, self).rotate(-position)
+        super(deque, self).appendleft(item)
+        super(deque, self).rotate(position)
+
+        self.reindex()
+        self.estimated(item)
+        self.changed("move", item)
+
+    def __setitem__(self, index, item):
+        super(deque, self).__setitem__(index, item)
+        self.reindex("reorder")
+
+    def __delitem__(self, index):
+        super(deque, self).__delitem__(index)
+        self.reindex("reorder")
+
+    def rotate(self, n=1):
+        super(deque, self).rotate(n)
+        self.reindex("reorder")
+
+    def reverse(self):
+        super(deque, self).reverse()
+        self.reindex("reorder")
+
+    def clear(self):
+        super(deque, self).clear()
+        self.reindex("clear")
 
 
 def public(function):
@@ -64,6 +351,18 @@ def public(function):
     return function
 
 
+def blocking(function):
+    """
+    Decorator for API functions that can wait for a long time. They are
+    only served by engines that handle calls concurrently, on others they
+    would hold up every other client, and never in a batch, which holds
+    the queue lock.
+    """
+    if function not in blocking_functions:
+        blocking_functions.append(function)
+    return function
+
+
 def commit(function):
     @functools.wraps(function)
     def save_after_execution(queue, *args, **kwargs):
@@ -86,49 +385,44 @@ def commit(function):
 #
             return function(queue, *args, **kwargs)
         finally:
-            run(save, queue)
+            queue.worker.save()
 
     return save_after_execution
 
 
-def normalize(song):
-    """
-    Takes a dictionary and fixes it to only have keys that
-    are fields on the `Entry` namedtuple.
-    """
-    plain = {key: None for key in Entry._fields}
-
-    for key, value in song.iteritems():
-        if key in plain:
-            plain[key] = value
-
-    return plain
-
-
 def create_entry(**song):
     """
     Returns a new Entry instance.
     """
-    song = normalize(song)
-
-    return Entry(**song)
+    return Entry.from_wire(song)
 
 
 @public
 @commit
 def pop(queue):
     """
-    Pops an item from the queue and returns it
+    Pops an item from the queue and returns it, entries that can no
+    longer be played are dropped first. The backend is told the entry is
+    played before the queue is populated again.
     """
+    backend = find_backend(queue.backend)
+
     with queue.lock:
+        while queue and not backend.usable(queue, queue[0]):
+            logger.warning("pop: dropping unusable entry %s", queue[0])
+            queue.remove(queue[0])
+
         entry = queue.popleft()
 
         logger.debug("pop: %s", entry)
         queue.next_song_estimate = time.time() + entry.length
 
-        run(populate, queue)
+        if entry.songid:
+            backend.played(queue, entry)
 
-        return entry
+        queue.worker.populate()
+
+        return entry.to_wire()
 
 
 @public
@@ -137,11 +431,11 @@ def peek(queue, index=0):
     Peeks at an index of the queue, returns the entry
     found at said index.
     """
-    with queue.lock:
-        try:
-            return queue[index]
-        except IndexError:
-            return None
+    snapshot = queue.snapshot()
+    try:
+        return EncodedDict(snapshot.entries[index], snapshot.encoded[index])
+    except IndexError:
+        return None
 
 
 @public
@@ -175,17 +469,28 @@ def append_request(queue, song):
 
 
 @public
-def slice(queue, start=0, end=None):
+def slice(queue, start=0, end=None, if_changed_since=None):
     """
     Returns part of the queue.
 
     Returns the full length queue if both arguments
     are kept as their default value.
+
+    If `if_changed_since` is given the result is a dictionary with the
+    current `version` and the `entries`, which are None if the queue
+    didn't change since that version.
     """
-    end = end if end is not None else len(queue)
+    snapshot = queue.snapshot()
+    entries = EncodedList(snapshot.entries[start:end],
+                          "[%s]" % ",".join(snapshot.encoded[start:end]))
+    if if_changed_since is None:
+        return entries
 
-    with queue.lock:
-        return list(queue)[start:end]
+    if if_changed_since == snapshot.version:
+        return {"version": snapshot.version, "entries": None}
+
+    return EncodedDict({"version": snapshot.version, "entries": entries},
+                       '{"version":%d,"entries":%s}' % (snapshot.version, entries.encoded))
 
 
 @public
@@ -193,6 +498,189 @@ def length(queue):
     return len(queue)
 
 
+@public
+def contains(queue, songid):
+    """
+    Returns True if `songid` is in the queue.
+    """
+    return songid in queue.songs
+
+
+@public
+def index_of(queue, songid):
+    """
+    Returns the position of the first entry of `songid` in the queue,
+    or None if it isn't queued.
+    """
+    with queue.lock:
+        entry = queue.find(songid)
+        if entry is None:
+            return None
+        return queue.index(entry)
+
+
+@public
+def find(queue, songid):
+    """
+    Returns the first entry of `songid` in the queue, or None if it isn't
+    queued.
+    """
+    with queue.lock:
+        entry = queue.find(songid)
+        if entry is None:
+            return None
+        index = queue.index(entry)
+        snapshot = queue.snapshot()
+
+    return EncodedDict(snapshot.entries[index], snapshot.encoded[index])
+
+
+@public
+@commit
+def remove(queue, songid):
+    """
+    Removes the first entry of `songid` from the queue and returns it,
+    returns None if it isn't queued.
+    """
+    with queue.lock:
+        entry = queue.find(songid)
+        if entry is None:
+            return None
+
+        queue.remove(entry)
+
+    logger.debug("remove: %s", entry)
+    return entry.to_wire()
+
+
+@public
+@commit
+def move(queue, songid, position):
+    """
+    Moves the first entry of `songid` to `position` in the queue and
+    returns its new position, returns None if it isn't queued.
+    """
+    with queue.lock:
+        entry = queue.find(songid)
+        if entry is None:
+            return None
+
+        queue.move(entry, position)
+        index = queue.index(entry)
+
+    logger.debug("move: %s to %d", entry, index)
+    return index
+
+
+@public
+def version(queue):
+    """
+    Returns the version of the queue, it changes on every modification.
+    """
+    return queue.version
+
+
+@public
+@blocking
+def wait_for_change(queue, version, timeout=30):
+    """
+    Waits up to `timeout` seconds for the queue to change from `version`.
+
+    Returns a dictionary with the current `version` and the `events` that
+    happened since the given version. `events` is None if the version is
+    too old, clients should then reload the queue with `slice`.
+    """
+    deadline = time.time() + min(timeout, MAX_WAIT)
+
+    with queue.condition:
+        while queue.version == version:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            queue.condition.wait(remaining)
+
+    current = queue.version
+    return {"version": current, "events": queue.events_since(version)}
+
+
+def stream_events(queue, query, headers):
+    """
+    Yields queue events formatted as server-sent events.
+
+    Starts after the version in the `version` query argument or the
+    `Last-Event-ID` header, or at the current version if neither is given.
+    """
+    version = query.get("version", [headers.get("Last-Event-ID")])[0]
+    version = queue.version if version is None else int(version)
+
+    while True:
+        change = wait_for_change(queue, version, timeout=15)
+        events = change["events"]
+
+        if events is None:
+            yield "id: {0}\nevent: reload\ndata: null\n\n".format(change["version"])
+        elif not events:
+            # Keeps idle connections from being dropped.
+            yield ": keep-alive\n\n"
+
+        for event in events or ():
+            yield "id: {0}\nevent: {1}\ndata: {2}\n\n".format(
+                event["version"], event["type"], json.dumps(event["entry"]))
+
+        version = change["version"]
+
+
+@public
+def persistence_stats(queue):
+    """
+    Returns the state of the persistence worker: pending changes (depth),
+    amount of saves and the duration and latency of the last save.
+    """
+    return queue.worker.stats()
+
+
+@public
+def cache_stats(queue):
+    """
+    Returns the size and hit rate of every cache, by cache name.
+    """
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+@public
+def pool_stats(queue):
+    """
+    Returns the size, waits, timeouts and reconnects of every connection
+    pool, by pool name.
+    """
+    return {name: pool.stats() for name, pool in pools.items()}
+
+
+@public
+def stats(queue):
+    """
+    Returns the call counts, errors, latency and queue lock wait
+    histograms of every RPC and backend hook, by name. This is empty
+    unless metrics are enabled.
+    """
+    return metrics.stats()
+
+
+def metrics_page(queues, query, headers):
+    """
+    Returns the metrics in the Prometheus text format, `queues` is a
+    dictionary of name => queue.
+    """
+    lines = ["# TYPE radio_queue_length gauge"]
+    lines.extend('radio_queue_length{{queue="{0}"}} {1}'.format(name, len(queue))
+                 for name, queue in sorted(queues.items()))
+    lines.append("# TYPE radio_queue_version counter")
+    lines.extend('radio_queue_version{{queue="{0}"}} {1}'.format(name, queue.version)
+                 for name, queue in sorted(queues.items()))
+
+    return "text/plain; version=0.0.4", "\n".join(lines) + "\n" + metrics.prometheus()
+
+
 def save(queue, backend=None):
     """
     Saves the queue.
@@ -225,61 +713,201 @@ def populate(queue, backend=None):
     return find_backend(backend).populate(queue)
 
 
-def run_server(host, port, backend="mysql", config=None):
+def shutdown(queue, backend=None):
+    """
+    Stops anything the backend runs for `queue`, this is called after the
+    last save.
+    """
+    backend = backend or queue.backend
+
+    logger.info("shutting down queue")
+    return find_backend(backend).shutdown(queue)
+
+
+def run_server(host, port, backend="mysql", config=None, engine="simple",
+               serializer=None):
     logger.setLevel(logging.DEBUG)
 
-    logger.info("initializing in-memory queue")
+    queues = create_queues(backend, config, serializer)
+    server = create_server(host, port, queues, engine,
+                           (config or {}).get("default_queue"))
+
+    for queue in queues.values():
+        queue.worker.start()
+
+    logger.info("starting jsonrpc server")
+    try:
+        server.serve_forever()
+    finally:
+        # Save before exiting
+        for queue in queues.values():
+            queue.worker.stop()
+            shutdown(queue)
+
+    logger.info("exiting...")
+
+
+def create_queues(backend="mysql", config=None, serializer=None):
+    """
+    Returns an ordered dictionary of name => queue of all queues in
+    `config`, see `create_queue`.
+
+    Every entry of the "queues" section of `config` is a queue, with the
+    settings that differ from the top level ones and its "backend". Nested
+    sections such as "mysql" are merged with the top level ones. Without
+    that section there is a single queue called "default", otherwise the
+    "default_queue" setting names the one that is also served on /. The
+    workers of all queues share a single thread, and queues with the same
+    database settings share its connection pool.
+    """
+    config = config or {}
+    shared = {key: value for key, value in config.items() if key != "queues"}
+    sections = config.get("queues") or {"default": {}}
+    group = WorkerGroup()
+
+    for name in sections:
+        if not QUEUE_NAME.match(name) or name in RESERVED_NAMES:
+            raise ValueError("invalid queue name: {0!r}".format(name))
+
+    queues = collections.OrderedDict()
+    for name, section in sorted(sections.items()):
+        options = dict(shared)
+        for key, value in section.items():
+            if isinstance(value, dict) and isinstance(options.get(key), dict):
+                value = dict(options[key])
+                value.update(section[key])
+            options[key] = value
+        queues[name] = create_queue(options.pop("backend", backend), options,
+                                    serializer, name, group)
+    return queues
+
+
+def create_queue(backend="mysql", config=None, serializer=None, name="default",
+                 group=None):
+    """
+    Returns a loaded and populated queue, its worker isn't started yet.
+    """
+    logger.info("initializing in-memory queue %s (%s)", name, backend)
     # Create our local queue
     queue = deque()
+    queue.name = name
     queue.backend = backend
     queue.config = config or {}
-    queue.lock = threading.RLock()
+    queue.serializer = find_serializer(serializer)
+
+    options = queue.config.get("metrics", {})
+    if options.get("enabled", False):
+        metrics.enable(options.get("buckets"))
+        queue.lock = TimedLock(queue.lock, metrics)
+        if backend not in timed_backends:
+            timed_backends.add(backend)
+            hooks = find_backend(backend)._asdict()
+            backends[backend] = Backend(**{
+                hook_name: metrics.timed("backend." + hook_name, hook)
+                for hook_name, hook in hooks.items()
+            })
+
+    persistence = queue.config.get("persistence", {})
+    queue.worker = Worker(
+        save=functools.partial(save, queue),
+        populate=functools.partial(populate, queue),
+        debounce=persistence.get("debounce", 0.5),
+        max_delay=persistence.get("max_delay", 5.0),
+        group=group,
+    )
 
     # Load any queue we've had active previously
     load(queue)
     # Make sure the queue is populated enough to be used
     populate(queue)
 
-    # Create copies of the API methods with our local queue applied
-    functions = wrap_functions(queue)
+    return queue
 
-    logger.info("initializing jsonrpc server")
-    # Setup the JSON RPC server and its methods
-    server = JSONServer((host, port), encoding="utf8", logRequests=False)
 
-    for function in functions:
-        logger.debug("-> registering jsonrpc function: %s", function)
-        server.register_function(function)
-
-    logger.info("starting jsonrpc server")
-    server.serve_forever()
-
-    # Save before exiting
-    save(queue)
+def create_server(host, port, queues, engine="simple", default=None):
+    """
+    Returns a JSON RPC server for `queues`, a dictionary of name => queue,
+    it isn't serving yet.
 
-    logger.info("exiting...")
+    Each queue is served on /<name>, with its events on /<name>/events,
+    by every engine. The `default` queue, the only or first one if not
+    given, is also served on / and /RPC2 with its events on /events.
 
+    Event streams and `blocking` functions are left out on engines that
+    don't handle calls concurrently.
+    """
+    if default is None:
+        default = "default" if "default" in queues else sorted(queues)[0]
+    elif default not in queues:
+        raise ValueError("default queue {0!r} doesn't exist".format(default))
 
-def wrap_functions(queue):
+    logger.info("initializing jsonrpc server (%s)", engine)
+    # Setup the JSON RPC server and its methods
+    server = engines[engine]((host, port), encoding="utf8", logRequests=False)
+    concurrent = getattr(server, "concurrent", False)
+    if not concurrent:
+        logger.info("%s engine runs one call at a time, long polls and event streams are disabled", engine)
+
+    server.routes = {}
+    server.streams = {}
+    server.unbatched = frozenset(func.__name__ for func in blocking_functions)
+    server.pages = {"/metrics": functools.partial(metrics_page, queues)}
+
+    for name, queue in queues.items():
+        route = Dispatcher(queue.lock, queue.serializer, encoding="utf8")
+        route.unbatched = server.unbatched
+        server.routes["/" + name] = route
+        if concurrent:
+            server.streams["/{0}/events".format(name)] = functools.partial(stream_events, queue)
+
+        dispatchers = [route]
+        if name == default:
+            server.batch_lock = queue.lock
+            server.serializer = queue.serializer
+            if concurrent:
+                server.streams["/events"] = functools.partial(stream_events, queue)
+            dispatchers.append(server)
+
+        # Create copies of the API methods with this queue applied
+        for function in wrap_functions(queue, concurrent):
+            logger.debug("-> registering jsonrpc function: %s (%s)", function, name)
+            for dispatcher in dispatchers:
+                dispatcher.register_function(function)
+
+    return server
+
+
+def wrap_functions(queue, concurrent=True):
     """
     Creates partials of all API functions with the queue instance
-    passed in as first argument.
+    passed in as first argument, `blocking` functions are left out unless
+    `concurrent` is True.
+
+    Their metrics are named after the function, prefixed with the name of
+    the queue unless it's the "default" one.
     """
+    prefix = "" if queue.name == "default" else queue.name + "."
     for func in api_functions:
-        yield functools.wraps(func)(functools.partial(func, queue))
-
+        if not concurrent and func in blocking_functions:
+            continue
 
-def run(function, *args, **kwargs):
-    thread = threading.Thread(target=function, args=args, kwargs=kwargs)
-    thread.daemon = True
-    thread.start()
+        function = functools.wraps(func)(functools.partial(func, queue))
+        if metrics.enabled:
+            function = metrics.timed(prefix + func.__name__, function)
+        yield function
 
 
-def register_backend(name, save, load, populate, expand=None, length=None):
+def register_backend(name, save, load, populate, expand=None, length=None,
+                     usable=None, played=None, shutdown=None):
     expand = expand or (lambda queue, item: item)
     length = length or (lambda queue: len(queue))
+    usable = usable or (lambda queue, item: True)
+    played = played or NOP
+    shutdown = shutdown or NOP
 
-    backends[name] = Backend(save=save, load=load, populate=populate, expand=expand, length=length)
+    backends[name] = Backend(save=save, load=load, populate=populate, expand=expand,
+                             length=length, usable=usable, played=played,
+                             shutdown=shutdown)
 
 
 def find_backend(name):
@@ -0,0 +1,369 @@
+from __future__ import absolute_import
+import collections
+import contextlib
+import functools
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+from .library import read_tags, walk
+from .selection import create_selector, fill_queue
+from .server import Entry, register_backend, logger
+from .worker import Tasks
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    length INTEGER,
+    meta TEXT,
+    usable INTEGER NOT NULL DEFAULT 1,
+    lastplayed REAL NOT NULL DEFAULT 0,
+    lastrequested REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tracks_path ON tracks (path);
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    entry TEXT
+);
+"""
+
+# Columns added to the tracks table after its first version, name => type
+COLUMNS = (
+    ("artist", "TEXT"),
+    ("plays", "INTEGER NOT NULL DEFAULT 0"),
+)
+
+TRACK_WEIGHTS = """
+SELECT id, artist, lastplayed, lastrequested, plays FROM tracks WHERE usable=1;
+"""
+
+SELECT_TRACKS = """
+SELECT id, path, length, meta FROM tracks WHERE id IN (%s);
+"""
+
+LR_UPDATE = """
+UPDATE tracks SET lastrequested=? WHERE id IN (%s);
+"""
+
+LP_UPDATE = """
+UPDATE tracks SET lastplayed=?, plays=plays+1 WHERE id=?;
+"""
+
+EXPAND = """
+SELECT path, length, meta FROM tracks WHERE id=?;
+"""
+
+INSERT_TRACK = """
+INSERT INTO tracks (path, length, meta) VALUES (?, ?, ?);
+"""
+
+IMPORT_TRACK = """
+INSERT INTO tracks (path, length, meta, artist, usable) VALUES (?, ?, ?, ?, ?);
+"""
+
+CATALOG_PATHS = """
+SELECT path, usable, length FROM tracks;
+"""
+
+SET_USABLE = """
+UPDATE tracks SET usable=? WHERE path=?;
+"""
+
+LOAD_JOURNAL = """
+SELECT op, entry FROM journal ORDER BY id ASC;
+"""
+
+APPEND_JOURNAL = """
+INSERT INTO journal (op, entry) VALUES (?, ?);
+"""
+
+DELETE_JOURNAL = """
+DELETE FROM journal;
+"""
+
+# Loads selection weights and scans music_root in the background.
+catalog_tasks = Tasks("radio.queue.sqlite.catalog")
+
+
+@contextlib.contextmanager
+def transaction(queue):
+    """
+    Returns a cursor inside a transaction on the database of `queue`, the
+    transaction is committed when the with block ends without an error.
+    """
+    with queue.database_lock:
+        cur = queue.database.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield cur
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        else:
+            cur.execute("COMMIT")
+        finally:
+            cur.close()
+
+
+def add_tracks(queue, tracks):
+    """
+    Adds (path, length, meta) tracks to the catalog, `path` is relative to
+    the music_root.
+    """
+    with transaction(queue) as cur:
+        cur.executemany(INSERT_TRACK, tracks)
+
+    refresh(queue)
+
+
+def scan(queue):
+    """
+    Brings the catalog up to date with the files below music_root.
+
+    New files are added with the tags read by `library.read_tags`, in a
+    pool of `sqlite.processes` processes. Files that can't be read are kept
+    as unusable so they aren't read again, and tracks whose file is gone
+    become unusable until it's back.
+    """
+    root = queue.config['music_root']
+    start = time.time()
+
+    with queue.database_lock:
+        known = {path: (usable, length)
+                 for path, usable, length in queue.database.execute(CATALOG_PATHS)}
+
+    found, new = set(), []
+    for filename in walk(root):
+        path = os.path.relpath(filename, root)
+        found.add(path)
+        if path not in known:
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            new.append((filename, stat.st_mtime, stat.st_size))
+
+    changed = [(0, path) for path, (usable, _) in known.items()
+               if usable and path not in found]
+    changed.extend((1, path) for path, (usable, length) in known.items()
+                   if not usable and length is not None and path in found)
+    if changed:
+        with transaction(queue) as cur:
+            cur.executemany(SET_USABLE, changed)
+
+    if new:
+        processes = queue.config.get("sqlite", {}).get("processes")
+        pool = multiprocessing.Pool(processes)
+        try:
+            rows = []
+            for filename, _, _, length, meta, artist in pool.imap_unordered(
+                    read_tags, new, chunksize=64):
+                rows.append((os.path.relpath(filename, root), length, meta,
+                             artist, int(length is not None)))
+                # Short transactions, so saves aren't held up for long.
+                if len(rows) >= 1000:
+                    with transaction(queue) as cur:
+                        cur.executemany(IMPORT_TRACK, rows)
+                    rows = []
+
+            with transaction(queue) as cur:
+                cur.executemany(IMPORT_TRACK, rows)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    logger.info("scanned %s in %.3fs: %d new files, %d tracks changed",
+                root, time.time() - start, len(new), len(changed))
+
+    if new or changed:
+        refresh(queue)
+
+
+def refresh(queue):
+    """
+    Reloads the selection weights of `queue` from the catalog, and fills
+    the queue up with them.
+    """
+    with queue.database_lock:
+        rows = queue.database.execute(TRACK_WEIGHTS).fetchall()
+
+    queue.selector.reset(rows)
+    queue.worker.populate()
+
+
+def populate(queue):
+    """
+    Populates any missing entries in the queue from the track catalog.
+    """
+    if queue.selector.stale():
+        catalog_tasks.submit(refresh, queue)
+
+    fill_queue(queue, queue.selector, functools.partial(entries, queue),
+               functools.partial(requested, queue))
+
+
+def entries(queue, songids):
+    """
+    Returns songid => Entry of the tracks in `songids` that are in the
+    catalog.
+    """
+    with queue.database_lock:
+        rows = queue.database.execute(
+            SELECT_TRACKS % ','.join(["?"] * len(songids)), songids).fetchall()
+
+    found = {}
+    for trackid, path, length, meta in rows:
+        entry = Entry(
+            songid=trackid,
+            length=length,
+            metadata=meta,
+            filename=os.path.join(queue.config.get('music_root', ''), path),
+            request=False,
+        )
+        entry._expanded = True
+        found[trackid] = entry
+    return found
+
+
+def requested(queue, songids):
+    with transaction(queue) as cur:
+        cur.execute(LR_UPDATE % ','.join(["?"] * len(songids)),
+                    [time.time()] + songids)
+
+
+def save(queue):
+    """
+    Saves the queue.
+
+    Appends and pops since the last save are added to the journal, any
+    other change, or a journal that grew too long, rewrites the journal
+    with the current queue instead.
+    """
+    compact = queue.config.get("sqlite", {}).get("compact", 1000)
+
+    with queue.lock:
+        events = queue.events_since(queue.saved_version)
+        version = queue.version
+
+        simple = events is not None and all(
+            event["type"] in ("append", "pop") for event in events)
+        if simple and queue.journal_length + len(events) > compact:
+            simple = False
+
+        if not simple:
+            entries = [queue.estimated(entry).to_wire() for entry in queue]
+
+    dumps = queue.serializer.dumps
+    played = [event["entry"]["songid"] for event in events or ()
+              if event["type"] == "pop" and event["entry"]["songid"]]
+
+    with transaction(queue) as cur:
+        now = time.time()
+        cur.executemany(LP_UPDATE, [(now, songid) for songid in played])
+
+        if simple:
+            for event in events:
+                if event["type"] == "append":
+                    cur.execute(APPEND_JOURNAL, ("append", dumps(event["entry"])))
+                else:
+                    cur.execute(APPEND_JOURNAL, ("pop", None))
+        else:
+            cur.execute(DELETE_JOURNAL)
+            cur.executemany(APPEND_JOURNAL,
+                            [("append", dumps(entry)) for entry in entries])
+
+    if simple:
+        queue.journal_length += len(events)
+    else:
+        queue.journal_length = len(entries)
+    queue.saved_version = version
+
+
+def load(queue):
+    """
+    Populates `queue` by replaying the journal.
+    """
+    options = queue.config.get("sqlite", {})
+
+    queue.database = sqlite3.connect(options.get("database", "queue.db"),
+                                     isolation_level=None,
+                                     check_same_thread=False)
+    queue.database.execute("PRAGMA journal_mode=WAL")
+    queue.database.execute("PRAGMA synchronous=NORMAL")
+    queue.database.executescript(SCHEMA)
+    existing = set(column[1] for column in
+                   queue.database.execute("PRAGMA table_info(tracks)"))
+    for name, kind in COLUMNS:
+        if name not in existing:
+            queue.database.execute("ALTER TABLE tracks ADD COLUMN {0} {1}".format(name, kind))
+    queue.database_lock = threading.Lock()
+    queue.selector = create_selector(queue.config)
+
+    start = time.time()
+    entries = collections.deque()
+    loads = queue.serializer.loads
+
+    queue.journal_length = 0
+    with queue.database_lock:
+        for op, data in queue.database.execute(LOAD_JOURNAL):
+            queue.journal_length += 1
+            if op == "append":
+                entries.append(data)
+            elif entries:
+                entries.popleft()
+
+    with queue.lock:
+        for data in entries:
+            entry = Entry.from_wire(loads(data))
+            entry._expanded = True
+            queue.append(entry)
+
+        queue.saved_version = queue.version
+
+    logger.info("replayed %d queue entries in %.3fs",
+                len(entries), time.time() - start)
+
+    refresh(queue)
+
+    # The catalog is filled from music_root unless sqlite.scan is false.
+    root = queue.config.get('music_root')
+    if options.get("scan", True) and root and os.path.isdir(root):
+        catalog_tasks.submit(scan, queue)
+
+
+def expand(queue, entry):
+    if not entry.songid or entry._expanded:
+        return entry
+
+    entry._expanded = True
+    with queue.database_lock:
+        track = queue.database.execute(EXPAND, (entry.songid,)).fetchone()
+
+    if track is None:
+        return entry
+
+    path, length, meta = track
+    if not entry.filename:
+        entry.filename = os.path.join(queue.config.get('music_root', ''), path)
+    if not entry.length:
+        entry.length = length
+    if not entry.metadata:
+        entry.metadata = meta
+
+    return entry
+
+
+def played(queue, entry):
+    """
+    Lowers the selection weight of a popped track, the catalog is updated
+    by the next save.
+    """
+    queue.selector.played(entry.songid)
+
+
+register_backend("sqlite", save, load, populate, expand, played=played)
@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+import logging
+import threading
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+logger = logging.getLogger("radio.queue")
+
+
+class PollingWatcher(object):
+    """
+    Keeps `library` up to date by scanning it every `interval` seconds.
+
+    `changed` is called after changes were applied to the library.
+    """
+    name = "poll"
+
+    def __init__(self, library, changed=None, interval=300, save_interval=60):
+        super(PollingWatcher, self).__init__()
+        self.library = library
+        self.changed = changed or (lambda: None)
+        self.interval = interval
+        self.save_interval = save_interval
+
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="radio.queue.watcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the thread and saves the library if it changed.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.library.dirty:
+            self.library.save()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.library.scan()
+            except Exception:
+                logger.exception("library scan failed")
+            else:
+                self.changed()
+
+
+class InotifyWatcher(PollingWatcher):
+    """
+    Keeps `library` up to date by applying the changes inotify reports.
+
+    The index is saved at most every `save_interval` seconds, a full scan
+    is only done when inotify dropped events.
+    """
+    name = "inotify"
+
+    def __init__(self, *args, **kwargs):
+        super(InotifyWatcher, self).__init__(*args, **kwargs)
+        # path => True if it was removed, False if it was added or changed
+        self.pending = {}
+        self.overflowed = False
+
+    def handle(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            self.overflowed = True
+        elif event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+            self.pending[event.pathname] = True
+        elif event.mask & pyinotify.IN_CREATE and not event.dir:
+            # The file is added once it's written, see IN_CLOSE_WRITE.
+            pass
+        else:
+            self.pending[event.pathname] = False
+
+    def apply(self):
+        pending, self.pending = self.pending, {}
+        overflowed, self.overflowed = self.overflowed, False
+
+        if overflowed:
+            logger.warning("inotify dropped events, rescanning library")
+            self.library.scan()
+        else:
+            for path, removed in pending.items():
+                if removed:
+                    self.library.remove(path)
+                else:
+                    self.library.update(path)
+
+        logger.debug("applied %d library changes", len(pending))
+        self.changed()
+
+    def run(self):
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+                pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO)
+
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, self.handle, timeout=1000)
+        manager.add_watch(self.library.root, mask, rec=True, auto_add=True)
+
+        saved = time.time()
+        try:
+            while not self.stopped.is_set():
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+
+                if self.pending or self.overflowed:
+                    try:
+                        self.apply()
+                    except Exception:
+                        logger.exception("applying library changes failed")
+
+                if self.library.dirty and time.time() - saved > self.save_interval:
+                    self.library.save()
+                    saved = time.time()
+        finally:
+            notifier.stop()
+
+
+# Watchers that can be used, name => watcher class
+watchers = {"poll": PollingWatcher}
+
+if pyinotify is not None:
+    watchers["inotify"] = InotifyWatcher
+
+
+def find_watcher(name=None):
+    """
+    Returns the watcher class called `name`, or inotify if it's available.
+    """
+    if name is None:
+        name = "inotify" if "inotify" in watchers else "poll"
+    return watchers[name]
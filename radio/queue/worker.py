@@ -0,0 +1,299 @@
+from __future__ import absolute_import
+import Queue
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger("radio.queue")
+
+# Longest time in seconds between attempts of a save that keeps failing.
+MAX_BACKOFF = 60.0
+
+
+class Worker(object):
+    """
+    A single long-lived thread that runs the `save` and `populate` hooks
+    of a queue.
+
+    Saves are coalesced: a burst of changes results in one save that runs
+    `debounce` seconds after the last change, but no later than `max_delay`
+    seconds after the first change. Since there is only one writer, and
+    every save takes a fresh snapshot, the last state always wins. A
+    failed save is retried after a delay that doubles with every failure
+    in a row, up to MAX_BACKOFF seconds.
+
+    Workers created with a `group` have no thread of their own, the
+    thread of the group runs their hooks.
+    """
+    def __init__(self, save, populate, debounce=0.5, max_delay=5.0, group=None):
+        super(Worker, self).__init__()
+        self._save = save
+        self._populate = populate
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.group = group
+
+        # Shared with the group, so changes wake up the thread of the group.
+        self.condition = group.condition if group is not None else threading.Condition()
+        # Held while a hook is running, so `flush` can't overlap the thread.
+        self.write_lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+        self.dirty = False
+        self.populating = False
+        # Amount of changes that haven't been saved yet.
+        self.pending = 0
+        self.first_change = None
+        self.last_change = None
+        # No save is attempted before this time after a failure.
+        self.retry_at = None
+
+        self.saves = 0
+        self.failures = 0
+        self.save_duration = None
+        self.flush_latency = None
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+
+        if self.group is not None:
+            self.group.add(self)
+            return
+
+        self.thread = threading.Thread(target=self.run, name="radio.queue.worker")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the thread and synchronously flushes anything still pending.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        if self.group is not None:
+            self.group.remove(self)
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        self.flush()
+
+    def save(self):
+        """
+        Marks the queue as dirty, it will be saved after the debounce window.
+        """
+        with self.condition:
+            now = time.time()
+            if not self.dirty:
+                self.dirty = True
+                self.first_change = now
+            self.last_change = now
+            self.pending += 1
+            self.condition.notify()
+
+    def populate(self):
+        """
+        Schedules a populate, this runs as soon as the thread is free.
+        """
+        with self.condition:
+            self.populating = True
+            self.condition.notify()
+
+    def flush(self):
+        """
+        Runs any pending populate and save in the calling thread.
+        """
+        with self.condition:
+            populating, self.populating = self.populating, False
+            dirty, self.dirty = self.dirty, False
+            pending, self.pending = self.pending, 0
+            first_change, self.first_change = self.first_change, None
+
+        with self.write_lock:
+            if populating:
+                try:
+                    self._populate()
+                except Exception:
+                    logger.exception("populate failed")
+                else:
+                    # populate appends to the queue behind our back.
+                    dirty = True
+                    first_change = first_change or time.time()
+
+            if not dirty:
+                return
+
+            start = time.time()
+            try:
+                self._save()
+            except Exception:
+                with self.condition:
+                    self.failures += 1
+                    backoff = min(self.debounce * 2 ** self.failures, MAX_BACKOFF)
+                    now = time.time()
+                    if not self.dirty:
+                        self.dirty = True
+                        self.first_change = first_change
+                    self.last_change = now
+                    self.retry_at = now + backoff
+                    self.pending += pending
+                logger.exception("save failed, retrying in %.1fs", backoff)
+                return
+
+            end = time.time()
+            with self.condition:
+                self.failures = 0
+                self.retry_at = None
+            self.saves += 1
+            self.save_duration = end - start
+            self.flush_latency = end - first_change
+
+    def deadline(self):
+        """
+        Returns the time at which the pending save should run.
+        """
+        deadline = min(self.last_change + self.debounce,
+                       self.first_change + self.max_delay)
+        if self.retry_at is not None:
+            deadline = max(deadline, self.retry_at)
+        return deadline
+
+    def due(self):
+        """
+        Returns the seconds until `flush` should run, 0 if it should run
+        now or None if nothing is pending. The condition has to be held.
+        """
+        if self.populating:
+            return 0
+        if self.dirty:
+            return max(self.deadline() - time.time(), 0)
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    timeout = self.due()
+                    if timeout == 0:
+                        break
+                    self.condition.wait(timeout)
+
+                if not self.running:
+                    return
+
+            self.flush()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "depth": self.pending,
+                "dirty": self.dirty,
+                "saves": self.saves,
+                "failures": self.failures,
+                "save_duration": self.save_duration,
+                "flush_latency": self.flush_latency,
+            }
+
+
+class WorkerGroup(object):
+    """
+    A single thread that runs the hooks of several workers, so hosting
+    more queues doesn't take more threads. The thread runs while any
+    worker of the group is started.
+    """
+    def __init__(self, name="radio.queue.worker"):
+        super(WorkerGroup, self).__init__()
+        self.name = name
+        self.condition = threading.Condition()
+        self.workers = []
+        self.thread = None
+
+    def add(self, worker):
+        with self.condition:
+            self.workers.append(worker)
+            self.condition.notify()
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def remove(self, worker):
+        """
+        Removes a worker, the thread is stopped after the last one.
+        """
+        with self.condition:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            self.condition.notify()
+
+            if self.workers:
+                return
+            thread, self.thread = self.thread, None
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def run(self):
+        current = threading.current_thread()
+        while True:
+            with self.condition:
+                while True:
+                    if self.thread is not current or not self.workers:
+                        return
+
+                    waits = [(worker.due(), worker) for worker in self.workers]
+                    due = [worker for timeout, worker in waits if timeout == 0]
+                    if due:
+                        break
+
+                    timeouts = [timeout for timeout, _ in waits if timeout is not None]
+                    self.condition.wait(min(timeouts) if timeouts else None)
+
+            for worker in due:
+                worker.flush()
+
+
+class Tasks(object):
+    """
+    A thread that runs submitted functions one after the other. The thread
+    is started on the first submit.
+    """
+    def __init__(self, name):
+        super(Tasks, self).__init__()
+        self.name = name
+        self.tasks = Queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, function, *args, **kwargs):
+        self.start()
+        self.tasks.put((function, args, kwargs))
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            self.thread = threading.Thread(target=self.run, name=self.name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            function, args, kwargs = self.tasks.get()
+            try:
+                function(*args, **kwargs)
+            except Exception:
+                logger.exception("%s: task failed", self.name)
+
+    def depth(self):
+        return self.tasks.qsize()
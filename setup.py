@@ -16,6 +16,7 @@ setup(
       ],
       extras_require={
           "mysql": ["mysql-python"],
+          "inotify": ["pyinotify"],
       },
       entry_points={
           "console_scripts": [